@@ -0,0 +1,104 @@
+import os
+import sys
+import threading
+from collections import OrderedDict
+from zdb_utils import *
+
+# DMU object types whose L0 blocks are user data, everything else is metadata
+DMU_DATA_TYPES = {19, 23}
+
+class BlockCache:
+    """Process-wide cache of decompressed blocks, keyed by (vdev, offset, birth).
+
+    Metadata (indirect blocks and non file data) and data blocks live in two
+    LRU lists sharing one byte budget. Data blocks are evicted first; metadata
+    is only evicted once it takes more than meta_ratio of the budget, or when
+    there is no data left to evict.
+    """
+    def __init__(self, max_bytes, meta_ratio=0.75):
+        self.max_bytes = max_bytes
+        self.meta_limit = int(max_bytes * meta_ratio)
+        self.lists = {True: OrderedDict(), False: OrderedDict()}
+        self.size = {True: 0, False: 0}
+        self.hits = {True: 0, False: 0}
+        self.misses = {True: 0, False: 0}
+        self.evictions = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, meta=True):
+        with self.lock:
+            for lru in self.lists.values():
+                buf = lru.get(key)
+                if buf is not None:
+                    lru.move_to_end(key)
+                    self.hits[meta] += 1
+                    return buf
+            self.misses[meta] += 1
+            return None
+
+    def put(self, key, buf, meta=True):
+        size = len(buf)
+        if size > self.max_bytes:
+            return
+        with self.lock:
+            lru = self.lists[meta]
+            if key in lru:
+                lru.move_to_end(key)
+                return
+            lru[key] = buf
+            self.size[meta] += size
+            self.evict()
+
+    def evict_one(self, meta):
+        key, buf = self.lists[meta].popitem(last=False)
+        self.size[meta] -= len(buf)
+        self.evictions += 1
+
+    def evict(self):
+        while self.size[True] + self.size[False] > self.max_bytes:
+            if self.size[True] > self.meta_limit or not self.lists[False]:
+                self.evict_one(True)
+            else:
+                self.evict_one(False)
+
+    def clear(self):
+        with self.lock:
+            for meta in self.lists:
+                self.lists[meta].clear()
+                self.size[meta] = 0
+
+    def dump(self, fd=sys.stderr):
+        for meta, name in [(True, "meta"), (False, "data")]:
+            print(f"arc {name}: {len(self.lists[meta])} blocks, {self.size[meta]:#x} bytes, hits {self.hits[meta]}, misses {self.misses[meta]}", file=fd)
+        print(f"arc evictions: {self.evictions}, max {self.max_bytes:#x} bytes", file=fd)
+
+block_cache = BlockCache(int(os.environ.get("ZDB_ARC_MAX", 256 << 20)))
+
+class DentryCache:
+    """Bounded LRU of resolved directory entries, (dir obj, name) -> (obj, type)"""
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.lru = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+
+    def get(self, dir_id, name):
+        with self.lock:
+            ent = self.lru.get((dir_id, name))
+            if ent is None:
+                self.misses += 1
+                return None
+            self.lru.move_to_end((dir_id, name))
+            self.hits += 1
+            return ent
+
+    def put(self, dir_id, name, ent):
+        with self.lock:
+            self.lru[(dir_id, name)] = ent
+            self.lru.move_to_end((dir_id, name))
+            while len(self.lru) > self.max_entries:
+                self.lru.popitem(last=False)
+
+    def dump(self, fd=sys.stderr):
+        print(f"dentry: {len(self.lru)} entries, hits {self.hits}, misses {self.misses}", file=fd)
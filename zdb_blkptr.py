@@ -1,10 +1,16 @@
 import struct
 from collections import namedtuple
-from zdb_vdev import vdev_read
+import numpy as np
+from zdb_vdev import VDEVHandler
+from zdb_checksum import checksum_verify, ChecksumPolicy, ChecksumError
+from zdb_compress import decompress
+from zdb_arc import block_cache, DMU_DATA_TYPES
 from zdb_utils import *
 import argparse
 
 class DVA:
+    __slots__ = ("idx", "dva_word", "vdev", "asize", "offset")
+
     def __init__(self, idx, data):
         self.idx = idx
         self.dva_word = data
@@ -23,89 +29,312 @@ class DVA:
         return self.desc()
 
 
+blkptr_struct = struct.Struct("@7Q16x7Q")
+BlkPtrProp = namedtuple("BlkPtrProp", "pbirth_txg lbith_txg fill b d x lvl type cksum e comp psize lsize")
+BlkPtrEmbdProp = namedtuple("BlkPtrEmbdProp", "pbirth_txg lbith_txg fill b d x lvl type etype e comp psize lsize")
+PROP_OFFSET_LIST = [(63, 1), (62, 1), (61, 1), (56, 5), (48, 8), (40, 8), (39, 1), (32, 7), (16, 16), (0, 16)]
+EMBD_PROP_OFFSET_LIST = [(63, 1), (62, 1), (61, 1), (56, 5), (48, 8), (40, 8), (39, 1), (32, 7), (25, 7), (0, 25)]
+
 class BlkPtr:
+    """blkptr_t decoded on demand.
+
+    The 128 bytes are unpacked with one precompiled struct on first access;
+    level, type, fill, sizes and the checksum words are read straight from
+    the unpacked words, while the DVA objects and the prop namedtuple are
+    only built when asked for.
+    """
     bs = 128
+    # indirect blocks read per batch while walking the tree
+    fanout_batch = 16
     BlockData = namedtuple("BlockData", ["id", "vdev", "offset", "buf"])
+    Hole = namedtuple("Hole", ["id", "nblks"])
 
-    cksum_dict = {
-        "7": fletcher4
-    }
-    decompress_dict = {
-        "2": lambda data, size: data,
-        "15": lz4_decompress
-    }
+    __slots__ = ("data", "handler", "_fields", "_dva", "_prop")
 
-    def __init__(self, data):
+    def __init__(self, data, handler=None):
         self.data = data
-        fields = struct.unpack("@7Q16x7Q", data[:self.bs])
-        self.dva = []
-        for idx in range(3):
-            dva = DVA(idx, [fields[2*idx], fields[2*idx+1]])
-            if dva.asize > 0:
-                self.dva.append(dva)
-
-        prop_int = fields[6]
-        self.embd = bits_get(prop_int, 39, 1) 
+        self.handler = handler
+        self._fields = None
+        self._dva = None
+        self._prop = None
+
+    @property
+    def fields(self):
+        if self._fields is None:
+            self._fields = blkptr_struct.unpack_from(self.data)
+        return self._fields
+
+    @property
+    def prop_int(self):
+        return self.fields[6]
+
+    @property
+    def embd(self):
+        return (self.prop_int >> 39) & 1
+
+    @property
+    def lvl(self):
+        return (self.prop_int >> 56) & 0x1f
+
+    @property
+    def type(self):
+        return (self.prop_int >> 48) & 0xff
+
+    @property
+    def comp(self):
+        return (self.prop_int >> 32) & 0x7f
+
+    @property
+    def cksum_type(self):
+        return (self.prop_int >> 40) & 0xff
+
+    @property
+    def encrypt(self):
+        return (self.prop_int >> 61) & 1
+
+    @property
+    def byteorder(self):
+        return (self.prop_int >> 63) & 1
+
+    @property
+    def fill(self):
+        return self.fields[9]
+
+    @property
+    def birth(self):
+        return self.fields[8]
+
+    @property
+    def lsize(self):
         if self.embd:
-            names = "pbirth_txg lbith_txg fill b d x lvl type etype e comp psize lsize"
-            prop_offset_list = [(63, 1), (62, 1), (61, 1), (56, 5), (48, 8), (40, 8), (39, 1), (32, 7), (25, 7), (0, 25)]
-            size_shift = 0
-        else:
-            names = "pbirth_txg lbith_txg fill b d x lvl type cksum e comp psize lsize"
-            prop_offset_list = [(63, 1), (62, 1), (61, 1), (56, 5), (48, 8), (40, 8), (39, 1), (32, 7), (16, 16), (0, 16)]
-            size_shift = 9
+            return (self.prop_int & 0x1ffffff) + 1
+        return ((self.prop_int & 0xffff) + 1) << 9
+
+    @property
+    def psize(self):
+        if self.embd:
+            return ((self.prop_int >> 25) & 0x7f) + 1
+        return (((self.prop_int >> 16) & 0xffff) + 1) << 9
+
+    @property
+    def iblk_cnt(self):
+        return self.lsize // self.bs
 
-        self.checksum = ":".join([f"{int(x):x}" for x in fields[-4:]])
+    @property
+    def cksum_words(self):
+        return self.fields[-4:]
 
-        prop_list = list(fields[7:10]) + [bits_get(prop_int, o, l) for o, l in prop_offset_list]
-        self.prop = namedtuple("BlkPtrProp", names)(*prop_list)
-        self.fields = fields
-        self.lvl = self.prop.lvl
+    @property
+    def checksum(self):
+        return cksum_str(self.cksum_words)
 
-        self.lsize = (self.prop.lsize + 1) << size_shift
-        self.psize = (self.prop.psize + 1) << size_shift
-        self.iblk_cnt = self.lsize // self.bs
-        self.iblk_cache = dict()
+    @property
+    def loc(self):
+        """(vdev, offset) of the first allocated DVA, None if none is;
+        taken from the DVA words without building DVA objects"""
+        fields = self.fields
+        for i in (0, 2, 4):
+            if fields[i] & 0xffffff:
+                return (fields[i] >> 32) & 0xffffff, (fields[i+1] & 0x7fffffffffffffff) << 9
+        return None
+
+    @property
+    def dva(self):
+        if self._dva is None:
+            fields = self.fields
+            self._dva = []
+            for idx in range(3):
+                dva = DVA(idx, [fields[2*idx], fields[2*idx+1]])
+                if dva.asize > 0:
+                    self._dva.append(dva)
+        return self._dva
+
+    @property
+    def prop(self):
+        if self._prop is None:
+            if self.embd:
+                prop_class, offset_list = BlkPtrEmbdProp, EMBD_PROP_OFFSET_LIST
+            else:
+                prop_class, offset_list = BlkPtrProp, PROP_OFFSET_LIST
+            prop_int = self.prop_int
+            self._prop = prop_class(*self.fields[7:10], *[bits_get(prop_int, o, l) for o, l in offset_list])
+        return self._prop
 
     def get_embddata(self):
         buf = self.data
-        return buf[:6*8] + buf[7*8:0xa*8] + buf[0xb*8:128]
+        return b"".join([buf[:6*8], buf[7*8:0xa*8], buf[0xb*8:128]])
+
+    def get_handler(self):
+        if self.handler is None:
+            return VDEVHandler.from_config()
+        return self.handler
 
     @classmethod
-    def vdev_read(cls, vdev_id, io_offset, psize, lsize, decompress_func, checksum=None):
-        buf = vdev_read(vdev_id, io_offset, psize)
+    def vdev_read(cls, vdev_id, io_offset, psize, lsize, comp, checksum=None, handler=None):
+        if handler is None:
+            handler = VDEVHandler.from_config()
+        buf = handler.read_vdev(vdev_id, io_offset, psize)
         _checksum = fletcher4(buf)
         if checksum:
             assert checksum == _checksum
-        _buf = cls.decompress_dict[decompress_func](buf, lsize)
+        _buf = decompress(int(comp), buf, lsize)
         return _buf, _checksum
 
-    def get_blkdata(self, blkid, nlevels=1):
-        if self.prop.x != 0:
+    def verify(self, raw_buf, policy=None):
+        if self.embd:
+            return False
+        return checksum_verify(self.cksum_type, raw_buf, self.cksum_words, self.lvl,
+                               big_endian=self.byteorder == 0, policy=policy)
+
+    def is_hole(self):
+        # an indirect blkptr with fill 0 has nothing allocated below it
+        return not self.embd and (self.fill == 0 or self.loc is None)
+
+    def is_meta(self):
+        return self.lvl > 0 or self.type not in DMU_DATA_TYPES
+
+    def cache_key(self):
+        vdev, offset = self.loc
+        return (vdev, offset, self.birth)
+
+    def read_data(self, policy=None, out=None):
+        """Read, verify and decompress the block this blkptr points to,
+        going through the shared block cache. Blocks decompressed into a
+        caller supplied out buffer are not cached, as out gets reused."""
+        if self.embd:
+            return decompress(self.comp, self.get_embddata()[:self.psize], self.lsize, out)
+        buf = block_cache.get(self.cache_key(), self.is_meta())
+        if buf is not None:
+            return buf
+        vdev, offset = self.loc
+        raw_buf = self.get_handler().read_vdev(vdev, offset, self.psize)
+        return self.finish_read(raw_buf, policy, out)
+
+    def finish_read(self, raw_buf, policy=None, out=None):
+        try:
+            self.verify(raw_buf, policy)
+        except ChecksumError as e:
+            raw_buf = self.read_alternate(e)
+        buf = decompress(self.comp, raw_buf, self.lsize, out)
+        if out is None:
+            block_cache.put(self.cache_key(), buf, self.is_meta())
+        return buf
+
+    @classmethod
+    def read_data_many(cls, bps, policy=None):
+        """read_data for a list of blkptrs; the blocks missing from the
+        cache are fetched with one batched VDEVHandler.read_many."""
+        bufs = [None] * len(bps)
+        misses = []
+        for i, bp in enumerate(bps):
+            if bp.embd:
+                bufs[i] = bp.read_data(policy)
+                continue
+            bufs[i] = block_cache.get(bp.cache_key(), bp.is_meta())
+            if bufs[i] is None:
+                misses.append(i)
+        if misses:
+            reqs = [(*bps[i].loc, bps[i].psize) for i in misses]
+            raw_bufs = bps[misses[0]].get_handler().read_many(reqs)
+            for i, raw_buf in zip(misses, raw_bufs):
+                bufs[i] = bps[i].finish_read(raw_buf, policy)
+        return bufs
+
+    def read_alternate(self, err):
+        """Try the redundant copies/reconstructions of the block after a
+        checksum error, return the first one that verifies."""
+        dva = self.dva[0]
+        debug_print0(f"BlkPtr: {err} at {dva}, trying redundancy", DEBUG_ZFS_BLK)
+        for raw_buf in self.get_handler().iter_alternates(dva.vdev, dva.offset, self.psize):
+            try:
+                self.verify(raw_buf, ChecksumPolicy())
+            except ChecksumError:
+                continue
+            debug_print0(f"BlkPtr: repaired {dva}", DEBUG_ZFS_BLK)
+            return raw_buf
+        raise err
+
+    def get_blkdata(self, blkid, nlevels=1, policy=None, out=None):
+        """Read the L0 block blkid below this blkptr.
+
+        out is an optional bytearray the L0 data is decompressed into,
+        indirect blocks always get their own buffers.
+        """
+        if self.encrypt != 0:
             raise NotImplementedError("BlkPTR encrypted data")
         if self.embd:
-            raw_buf = self.get_embddata()
-            buf = lz4_decompress(raw_buf, self.lsize)
-            return self.BlockData(blkid, -1, -1, buf)
+            return self.BlockData(blkid, -1, -1, self.read_data(policy, out))
         
-        if self.prop.fill == 0:
+        if self.fill == 0:
             debug_print1(f"BlkPTR: skip empty block: L{self.lvl} {blkid}", DEBUG_ZFS_BLK)
             return self.BlockData(blkid, -1, -1, None)
 
-        dva = self.dva[0]
-        debug_print2(f"{'  '*(nlevels - self.lvl -1)}BlkPtr: L{self.lvl} {dva}", DEBUG_ZFS_BLK)
-        raw_buf = vdev_read(dva.vdev, dva.offset, self.psize)
-        assert fletcher4(raw_buf) == self.checksum
-        buf = self.decompress_dict[f"{self.prop.comp}"](raw_buf, self.lsize)
+        vdev, offset = self.loc
+        debug_print2(f"{'  '*(nlevels - self.lvl -1)}BlkPtr: L{self.lvl} <{vdev}:{offset:x}>", DEBUG_ZFS_BLK)
+        buf = self.read_data(policy, out if self.lvl == 0 else None)
 
         if self.lvl == 0:
-            debug_print1(f"ZFS_BLK: L{self.lvl} {dva}", DEBUG_ZFS_BLK)
-            return self.BlockData(blkid, dva.vdev, dva.offset, buf)
+            debug_print1(f"ZFS_BLK: L{self.lvl} <{vdev}:{offset:x}>", DEBUG_ZFS_BLK)
+            return self.BlockData(blkid, vdev, offset, buf)
         # recursive to next level data block
-        iblk_offset = (blkid // (self.iblk_cnt**(self.lvl-1))) * self.bs
-        blkptr = BlkPtr(buf[iblk_offset:iblk_offset+self.bs])
-        return blkptr.get_blkdata(blkid, nlevels)
+        iblk_offset = (blkid // (self.iblk_cnt**(self.lvl-1))) % self.iblk_cnt * self.bs
+        blkptr = BlkPtr(buf[iblk_offset:iblk_offset+self.bs], self.handler)
+        return blkptr.get_blkdata(blkid, nlevels, policy, out)
+
+    def iter_l0(self, start_blkid=0, policy=None, holes=False, span=1):
+        """Depth-first walk of the tree below this blkptr, yield
+        (blkid, L0 BlkPtr) in blkid order. Each indirect block is read once,
+        holes are skipped together with their whole subtree.
 
+        With holes=True a hole covering span blocks is yielded as
+        (blkid, Hole(blkid, span)) instead of being skipped.
+        """
+        if self.is_hole():
+            if holes:
+                yield start_blkid, self.Hole(start_blkid, span)
+            return
+        if self.lvl == 0:
+            yield start_blkid, self
+            return
+        children = self.read_array(policy)
+        child_span = self.iblk_cnt ** (self.lvl - 1)
+        alive = np.flatnonzero(~children.holes())
+        if holes:
+            idx = range(len(children))
+        else:
+            idx = alive
+        group = -1
+        for i in idx:
+            i = int(i)
+            if self.lvl >= 2 and i // self.fanout_batch != group:
+                # entering a new group of fanout_batch children (its first
+                # ones may be holes): fetch its indirect blocks in one
+                # batch, the recursion below then finds them in the cache
+                group = i // self.fanout_batch
+                lo = group * self.fanout_batch
+                batch = alive[(alive >= lo) & (alive < lo + self.fanout_batch) & (children.embd[alive] == 0)]
+                if len(batch) > 1:
+                    self.read_data_many(children.bps(batch), policy)
+            yield from children[i].iter_l0(start_blkid + i*child_span, policy, holes, child_span)
+
+    def read_array(self, policy=None):
+        """Read this indirect block and decode its children as a BlkPtrArray"""
+        assert self.lvl > 0, "BlkPtr: read_array on a L0 block"
+        return BlkPtrArray(self.read_data(policy), self.handler)
+
+    def iter_arrays(self, start_blkid=0, policy=None):
+        """Depth-first walk yielding (lvl, blkid, BlkPtrArray) for every
+        indirect block below this blkptr, lvl being the level of the
+        blkptrs in it and blkid the first L0 block it covers."""
+        if self.is_hole() or self.lvl == 0:
+            return
+        children = self.read_array(policy)
+        yield self.lvl - 1, start_blkid, children
+        if self.lvl == 1:
+            return
+        child_span = self.iblk_cnt ** (self.lvl - 1)
+        for i in np.flatnonzero(~children.holes()):
+            yield from children[int(i)].iter_arrays(start_blkid + int(i)*child_span, policy)
 
     @staticmethod
     def get_two_int(info, base, sep="/", callback=lambda x: x):
@@ -115,8 +344,8 @@ class BlkPtr:
         return s1, callback(s1)
 
     @classmethod
-    def read_ptr(cls, addr, base=16):
-        decompress = "2"
+    def read_ptr(cls, addr, base=16, handler=None):
+        comp = 2
         fields = addr.split(":")
         dev, _io_offset, size_info = fields[:3]
         if len(fields) == 4:
@@ -126,7 +355,7 @@ class BlkPtr:
 
         lsize, psize = cls.get_two_int(size_info, base)
         if 'd' in opcode:
-            decompress = "15"
+            comp = 15
 
         io_offset = int(_io_offset, base)
         try:
@@ -136,31 +365,137 @@ class BlkPtr:
                 f.seek(io_offset)
                 raw_buf = f.read(psize)
         else:
-            raw_buf = vdev_read(vdev_id, io_offset, psize)
+            if handler is None:
+                handler = VDEVHandler.from_config()
+            raw_buf = handler.read_vdev(vdev_id, io_offset, psize)
 
         print(lsize)
-        buf = cls.decompress_dict[decompress](raw_buf, lsize)
+        buf = decompress(comp, raw_buf, lsize)
         if 'c' in opcode:
             print(f"cksum={fletcher4(raw_buf)}", file=sys.stderr)
         if 'r' in opcode:
             std_write(buf)
         if 'i' in opcode:
-            cnt = len(buf) // BlkPtr.bs
-            for i in range(cnt):
-                bp = BlkPtr(buf[i*BlkPtr.bs : (i+1)*BlkPtr.bs])
+            bps = BlkPtrArray(buf, handler)
+            for i in np.flatnonzero(bps.type != 0):
+                bp = bps[int(i)]
                 print(bp, bp.checksum, bp.prop)
+            bps.show_stats()
 
     def desc(self):
-        assert self.prop.type != 0, "BLKPTR Type is 0"
+        assert self.type != 0, "BLKPTR Type is 0"
 
         if self.embd == 1:
-            return f"[L{self.lvl} {self.prop.type} EMBD {self.lsize:x}L/{self.psize}P]"
+            return f"[L{self.lvl} {self.type} EMBD {self.lsize:x}L/{self.psize}P]"
 
         dva = self.dva[0].desc(self.lsize, self.psize)
-        return f"[L{self.lvl} {self.prop.type} {dva}]"
+        return f"[L{self.lvl} {self.type} {dva}]"
 
     def show(self):
         print(self.desc())
 
     def __repr__(self):
         return self.desc()
+
+
+BLKPTR_DTYPE = np.dtype([
+    ("vdev", np.uint32),
+    ("offset", np.uint64),
+    ("asize", np.uint64),
+    ("ndva", np.uint8),
+    ("lsize", np.uint32),
+    ("psize", np.uint32),
+    ("comp", np.uint8),
+    ("cksum", np.uint8),
+    ("lvl", np.uint8),
+    ("type", np.uint8),
+    ("embd", np.uint8),
+    ("birth", np.uint64),
+    ("fill", np.uint64),
+    ("cksum_words", np.uint64, (4,)),
+])
+
+class BlkPtrArray:
+    """All the blkptrs of an indirect block, decoded at once.
+
+    The columns (vdev, offset, asize of DVA[0], ndva, lsize, psize, comp,
+    cksum, lvl, type, embd, birth, fill, cksum_words) form a NumPy
+    structured array, so blkptrs can be filtered, summed and sorted
+    without building a BlkPtr for each. Indexing returns a BlkPtr over the
+    same 128 bytes. Embedded blkptrs have no DVA: vdev, offset and asize
+    are 0 for them.
+    """
+    def __init__(self, buf, handler=None):
+        self.buf = memoryview(buf)
+        self.handler = handler
+        words = np.frombuffer(self.buf, dtype=np.uint64, count=len(self.buf) // 8).reshape(-1, BlkPtr.bs // 8)
+        self.array = self.decode(words)
+
+    @staticmethod
+    def decode(words):
+        u = np.uint64
+        prop = words[:, 6]
+        embd = (prop >> u(39)) & u(1)
+        dva = embd == 0
+        array = np.zeros(len(words), dtype=BLKPTR_DTYPE)
+        array["vdev"] = np.where(dva, (words[:, 0] >> u(32)) & u(0xffffff), 0)
+        array["asize"] = np.where(dva, (words[:, 0] & u(0xffffff)) << u(9), 0)
+        array["offset"] = np.where(dva, (words[:, 1] & u((1 << 63) - 1)) << u(9), 0)
+        array["ndva"] = np.where(dva, sum((words[:, 2*i] & u(0xffffff)) != 0 for i in range(3)), 0)
+        array["lsize"] = np.where(dva, ((prop & u(0xffff)) + u(1)) << u(9), (prop & u(0x1ffffff)) + u(1))
+        array["psize"] = np.where(dva, (((prop >> u(16)) & u(0xffff)) + u(1)) << u(9), ((prop >> u(25)) & u(0x7f)) + u(1))
+        array["comp"] = (prop >> u(32)) & u(0x7f)
+        array["cksum"] = (prop >> u(40)) & u(0xff)
+        array["type"] = (prop >> u(48)) & u(0xff)
+        array["lvl"] = (prop >> u(56)) & u(0x1f)
+        array["embd"] = embd
+        array["birth"] = words[:, 10]
+        array["fill"] = words[:, 11]
+        array["cksum_words"] = words[:, 12:16]
+        return array
+
+    def __len__(self):
+        return len(self.array)
+
+    def __getattr__(self, name):
+        # columns, e.g. bps.offset
+        if name in BLKPTR_DTYPE.names:
+            return self.array[name]
+        raise AttributeError(name)
+
+    def __getitem__(self, i):
+        return BlkPtr(self.buf[i*BlkPtr.bs:(i+1)*BlkPtr.bs], self.handler)
+
+    def bps(self, idx=None):
+        """BlkPtr objects for the given indexes (all by default)"""
+        if idx is None:
+            idx = range(len(self))
+        return [self[int(i)] for i in idx]
+
+    def holes(self):
+        """mask of the blkptrs BlkPtr.is_hole() is True for"""
+        return (self.array["embd"] == 0) & ((self.array["fill"] == 0) | (self.array["ndva"] == 0))
+
+    def allocated(self):
+        """indexes of the blkptrs with a DVA on disk"""
+        return np.flatnonzero(~self.holes() & (self.array["embd"] == 0))
+
+    def by_offset(self, idx=None):
+        """allocated indexes (or idx) sorted by (vdev, offset)"""
+        if idx is None:
+            idx = self.allocated()
+        order = np.lexsort((self.array["offset"][idx], self.array["vdev"][idx]))
+        return idx[order]
+
+    def stats(self, idx=None):
+        """(count, lsize, psize, asize) totals over idx (allocated by default)"""
+        if idx is None:
+            idx = self.allocated()
+        array = self.array[idx]
+        return (len(array), int(array["lsize"].sum(dtype=np.uint64)),
+                int(array["psize"].sum(dtype=np.uint64)), int(array["asize"].sum(dtype=np.uint64)))
+
+    def show_stats(self, fd=sys.stderr):
+        cnt, lsize, psize, asize = self.stats()
+        nholes = int(self.holes().sum())
+        print(f"blkptrs: {cnt} allocated, {nholes} holes, {lsize:#x}L/{psize:#x}P/{asize:#x}A", file=fd)
@@ -0,0 +1,183 @@
+import hashlib
+import itertools
+import os
+import numpy as np
+from zdb_utils import *
+
+try:
+    import blake3
+except ImportError:
+    blake3 = None
+
+try:
+    import skein
+except ImportError:
+    skein = None
+
+# enum zio_checksum, same order as the on-disk blkptr checksum field
+ZIO_CHECKSUM_NAMES = [
+    "inherit", "on", "off", "label", "gang_header", "zilog", "fletcher2",
+    "fletcher4", "sha256", "zilog2", "noparity", "sha512", "skein", "edonr",
+    "blake3",
+]
+
+class ChecksumError(AssertionError):
+    def __init__(self, cksum_type, expect, actual):
+        self.cksum_type = cksum_type
+        self.expect = expect
+        self.actual = actual
+        super().__init__(f"{cksum_name(cksum_type)} mismatch: expect {cksum_str(expect)}, got {cksum_str(actual)}")
+
+def cksum_name(cksum_type):
+    if 0 <= cksum_type < len(ZIO_CHECKSUM_NAMES):
+        return ZIO_CHECKSUM_NAMES[cksum_type]
+    return f"checksum<{cksum_type}>"
+
+class ChecksumRegistry:
+    type_to_algo = dict()
+    # per pool salt for the salted algorithms (skein, edonr, blake3),
+    # MOS object directory "org.illumos:checksum_salt"
+    salt = None
+
+    @classmethod
+    def register(cls, algo_class):
+        algo = algo_class()
+        for cksum_type in algo_class.my_types:
+            cls.type_to_algo[cksum_type] = algo
+
+    @classmethod
+    def get(cls, cksum_type):
+        return cls.type_to_algo.get(cksum_type)
+
+class ChecksumCommon:
+    my_types = []
+    salted = False
+
+    def __init_subclass__(cls, **kwargs):
+        ChecksumRegistry.register(cls)
+
+    def available(self):
+        return not self.salted or ChecksumRegistry.salt is not None
+
+    def compute(self, data, big_endian=False):
+        raise NotImplementedError(f"checksum {self.__class__.__name__}")
+
+class ChecksumFletcher2(ChecksumCommon):
+    # zilog and zilog2 blocks carry their checksum embedded in the block
+    # trailer, not in the blkptr, so they are left unregistered and skipped
+    my_types = [6]
+
+    def compute(self, data, big_endian=False):
+        words = np.frombuffer(data, dtype=">u8" if big_endian else "<u8").astype(np.uint64)
+        pairs = words.reshape(-1, 2)
+        if len(pairs) == 0:
+            return (0, 0, 0, 0)
+        a = pairs.sum(axis=0, dtype=np.uint64)
+        b = fletcher4_coefs(len(pairs))[0] @ pairs
+        return (int(a[0]), int(a[1]), int(b[0]), int(b[1]))
+
+class ChecksumFletcher4(ChecksumCommon):
+    my_types = [1, 7]
+
+    def compute(self, data, big_endian=False):
+        if big_endian:
+            data = np.frombuffer(data, dtype=">u4")
+        return fletcher4_words(data)
+
+class ChecksumSHA(ChecksumCommon):
+    my_types = []
+    hash_name = None
+
+    def compute(self, data, big_endian=False):
+        digest = hashlib.new(self.hash_name, data).digest()
+        return tuple(int.from_bytes(digest[i:i+8], "big") for i in range(0, 32, 8))
+
+class ChecksumSHA256(ChecksumSHA):
+    my_types = [8]
+    hash_name = "sha256"
+
+class ChecksumSHA512(ChecksumSHA):
+    # the "sha512" property is SHA-512/256
+    my_types = [11]
+    hash_name = "sha512_256"
+
+class ChecksumBlake3(ChecksumCommon):
+    my_types = [14]
+    salted = True
+
+    def available(self):
+        return blake3 is not None and super().available()
+
+    def compute(self, data, big_endian=False):
+        digest = blake3.blake3(data, key=ChecksumRegistry.salt).digest()
+        return tuple(int.from_bytes(digest[i:i+8], "little") for i in range(0, 32, 8))
+
+class ChecksumSkein(ChecksumCommon):
+    # Skein-512 with a 256 bit digest, keyed with the pool salt
+    my_types = [12]
+    salted = True
+
+    def available(self):
+        return skein is not None and super().available()
+
+    def compute(self, data, big_endian=False):
+        digest = skein.skein512(data, digest_bits=256, key=ChecksumRegistry.salt).digest()
+        return tuple(int.from_bytes(digest[i:i+8], "little") for i in range(0, 32, 8))
+
+class ChecksumEdonr(ChecksumCommon):
+    # no edonr module, stays unavailable
+    my_types = [13]
+    salted = True
+
+    def available(self):
+        return False
+
+class ChecksumPolicy:
+    """Decide which blocks get their checksum verified.
+
+    verify:         every block (scrub)
+    verify-sampled: every indirect block and one in sample_every L0 blocks
+    skip:           nothing (bulk extraction from trusted media)
+    """
+    VERIFY = "verify"
+    SAMPLED = "verify-sampled"
+    SKIP = "skip"
+    modes = [VERIFY, SAMPLED, SKIP]
+
+    def __init__(self, mode=VERIFY, sample_every=16):
+        assert mode in self.modes, f"unknown checksum policy: {mode}"
+        self.mode = mode
+        self.sample_every = sample_every
+        self.counter = itertools.count()
+
+    def should_verify(self, lvl=0):
+        if self.mode == self.SKIP:
+            return False
+        if self.mode == self.VERIFY or lvl > 0:
+            return True
+        return next(self.counter) % self.sample_every == 0
+
+    def __repr__(self):
+        return f"<ChecksumPolicy:{self.mode}>"
+
+ChecksumPolicy.default = ChecksumPolicy(os.environ.get("ZDB_CKSUM_POLICY", ChecksumPolicy.VERIFY))
+
+def checksum_verify(cksum_type, data, expect, lvl=0, big_endian=False, policy=None):
+    """Verify data against the blkptr checksum words.
+
+    Returns True if verified, False if the policy or a missing algorithm
+    skipped it, and raises ChecksumError on mismatch.
+    """
+    if policy is None:
+        policy = ChecksumPolicy.default
+    if not policy.should_verify(lvl):
+        return False
+    algo = ChecksumRegistry.get(cksum_type)
+    if algo is None or not algo.available():
+        if cksum_type not in [2, 5, 9, 10]:
+            debug_print1(f"checksum: {cksum_name(cksum_type)} not available, skip verify", DEBUG_ZFS_BLK)
+        return False
+    actual = algo.compute(data, big_endian)
+    if actual != tuple(expect):
+        raise ChecksumError(cksum_type, expect, actual)
+    return True
@@ -0,0 +1,235 @@
+import struct
+import sys
+import threading
+import time
+import zlib
+from contextlib import contextmanager
+from lz4 import block
+from zdb_utils import *
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# enum zio_compress, same order as the on-disk blkptr comp field
+ZIO_COMPRESS_NAMES = [
+    "inherit", "on", "off", "lzjb", "empty", "gzip-1", "gzip-2", "gzip-3",
+    "gzip-4", "gzip-5", "gzip-6", "gzip-7", "gzip-8", "gzip-9", "zle", "lz4",
+    "zstd",
+]
+
+def comp_name(comp):
+    if 0 <= comp < len(ZIO_COMPRESS_NAMES):
+        return ZIO_COMPRESS_NAMES[comp]
+    return f"compress<{comp}>"
+
+class BufferPool:
+    """Free lists of bytearrays, one per size, so block sized output buffers
+    are recycled instead of reallocated for every block."""
+    def __init__(self, max_per_size=64):
+        self.max_per_size = max_per_size
+        self.free = dict()
+        self.lock = threading.Lock()
+
+    def get(self, size):
+        with self.lock:
+            bufs = self.free.get(size)
+            if bufs:
+                return bufs.pop()
+        return bytearray(size)
+
+    def put(self, buf):
+        with self.lock:
+            bufs = self.free.setdefault(len(buf), [])
+            if len(bufs) < self.max_per_size:
+                bufs.append(buf)
+
+    @contextmanager
+    def buffer(self, size):
+        buf = self.get(size)
+        try:
+            yield buf
+        finally:
+            self.put(buf)
+
+buffer_pool = BufferPool()
+
+class CodecStats:
+    def __init__(self):
+        self.stats = dict()    # name -> [calls, in_bytes, out_bytes, seconds]
+        self.lock = threading.Lock()
+
+    def add(self, name, in_bytes, out_bytes, seconds):
+        with self.lock:
+            st = self.stats.setdefault(name, [0, 0, 0, 0.0])
+            st[0] += 1
+            st[1] += in_bytes
+            st[2] += out_bytes
+            st[3] += seconds
+
+    def dump(self, fd=sys.stderr):
+        for name, (calls, in_bytes, out_bytes, seconds) in sorted(self.stats.items()):
+            rate = out_bytes / seconds / (1 << 20) if seconds > 0 else 0
+            print(f"{name:>8}: {calls} blocks, {in_bytes:#x} -> {out_bytes:#x} bytes, {seconds:.3f}s, {rate:.1f} MB/s", file=fd)
+
+codec_stats = CodecStats()
+
+class CompressRegistry:
+    type_to_codec = dict()
+
+    @classmethod
+    def register(cls, codec_class):
+        codec = codec_class()
+        for comp in codec_class.my_types:
+            cls.type_to_codec[comp] = codec
+
+    @classmethod
+    def get(cls, comp):
+        codec = cls.type_to_codec.get(comp)
+        if codec is None or not codec.available():
+            raise NotImplementedError(f"decompress {comp_name(comp)}")
+        return codec
+
+class CodecCommon:
+    my_types = []
+    # True if decompress() writes into out, False if it returns a new buffer
+    inplace = False
+
+    def __init_subclass__(cls, **kwargs):
+        CompressRegistry.register(cls)
+
+    def available(self):
+        return True
+
+    def decompress(self, src, lsize, out):
+        """Decompress src (a memoryview) into out[:lsize] for inplace
+        codecs, otherwise return a new buffer (out is None)."""
+        raise NotImplementedError
+
+class CodecOff(CodecCommon):
+    my_types = [2]
+
+    def decompress(self, src, lsize, out):
+        # hand back the caller's buffer itself rather than a view when possible
+        if isinstance(src.obj, (bytes, bytearray)) and len(src.obj) == lsize:
+            return src.obj
+        return src[:lsize]
+
+class CodecEmpty(CodecCommon):
+    my_types = [4]
+    inplace = True
+
+    def decompress(self, src, lsize, out):
+        out[:lsize] = bytes(lsize)
+        return out
+
+class CodecLZ4(CodecCommon):
+    my_types = [15]
+
+    def decompress(self, src, lsize, out):
+        # 4 bytes big endian compressed length, then a raw lz4 block
+        buf_size = struct.unpack_from(">I", src)[0]
+        assert buf_size + 4 <= len(src), f"lz4: bad length {buf_size:#x}"
+        return block.decompress(src[4:buf_size+4], uncompressed_size=lsize)
+
+class CodecGzip(CodecCommon):
+    my_types = list(range(5, 14))
+
+    def decompress(self, src, lsize, out):
+        # zlib stream, the padding up to psize is left in unused_data
+        return zlib.decompressobj().decompress(src, lsize)
+
+class CodecZstd(CodecCommon):
+    my_types = [16]
+
+    def available(self):
+        return zstandard is not None
+
+    def decompress(self, src, lsize, out):
+        # zfs_zstdhdr_t: big endian c_len, big endian version/level, then
+        # a frame written without the zstd magic number
+        c_len = struct.unpack_from(">I", src)[0]
+        assert c_len + 8 <= len(src), f"zstd: bad length {c_len:#x}"
+        dctx = zstandard.ZstdDecompressor(format=zstandard.FORMAT_ZSTD1_MAGICLESS)
+        return dctx.decompress(src[8:c_len+8], max_output_size=lsize)
+
+class CodecZle(CodecCommon):
+    my_types = [14]
+    inplace = True
+    level = 64
+
+    def decompress(self, src, lsize, out):
+        n = self.level
+        s, d, s_end = 0, 0, len(src)
+        while s < s_end and d < lsize:
+            length = 1 + src[s]
+            s += 1
+            if length <= n:
+                out[d:d+length] = src[s:s+length]
+                s += length
+            else:
+                length -= n
+                out[d:d+length] = bytes(length)
+            d += length
+        assert d == lsize, f"zle: decompressed {d:#x} of {lsize:#x}"
+        return out
+
+class CodecLzjb(CodecCommon):
+    my_types = [3]
+    inplace = True
+    MATCH_BITS = 6
+    MATCH_MIN = 3
+    OFFSET_MASK = (1 << (16 - MATCH_BITS)) - 1
+
+    def decompress(self, src, lsize, out):
+        s, d = 0, 0
+        copymask, copymap = 1 << 7, 0
+        while d < lsize:
+            copymask <<= 1
+            if copymask == (1 << 8):
+                copymask = 1
+                copymap = src[s]
+                s += 1
+            if copymap & copymask:
+                mlen = (src[s] >> (8 - self.MATCH_BITS)) + self.MATCH_MIN
+                offset = ((src[s] << 8) | src[s+1]) & self.OFFSET_MASK
+                s += 2
+                cpy = d - offset
+                assert cpy >= 0, "lzjb: bad match offset"
+                mlen = min(mlen, lsize - d)
+                if offset >= mlen:
+                    out[d:d+mlen] = out[cpy:cpy+mlen]
+                else:
+                    for i in range(mlen):
+                        out[d+i] = out[cpy+i]
+                d += mlen
+            else:
+                out[d] = src[s]
+                s += 1
+                d += 1
+        return out
+
+def decompress(comp, src, lsize, out=None):
+    """Decompress a block, dispatching on the blkptr comp field.
+
+    out is an optional bytearray of at least lsize bytes (e.g. from
+    buffer_pool) that inplace codecs decompress into; the others return
+    their own buffer rather than paying for a copy into out. Returns a
+    buffer of exactly lsize bytes, use it and not out.
+    """
+    codec = CompressRegistry.get(comp)
+    src = memoryview(src)
+    start = time.perf_counter()
+    if codec.inplace:
+        if out is None:
+            out = bytearray(lsize)
+        codec.decompress(src, lsize, out)
+        buf = out
+    else:
+        buf = codec.decompress(src, lsize, None)
+        assert len(buf) == lsize, f"{comp_name(comp)}: decompressed {len(buf):#x} of {lsize:#x}"
+    if len(buf) != lsize:
+        buf = memoryview(buf)[:lsize]
+    codec_stats.add(comp_name(comp), len(src), lsize, time.perf_counter() - start)
+    return buf
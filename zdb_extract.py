@@ -0,0 +1,207 @@
+#!/usr/bin/env python3
+
+import argparse
+import functools
+import multiprocessing
+import os
+import stat
+import time
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from zdb_blkptr import BlkPtr
+from zdb_vdev import VDEVHandler
+from zdb_checksum import ChecksumPolicy
+from zdb_compress import buffer_pool
+from zdb_prefetch import Prefetcher
+from zdb_obj import DMUObjset
+from zdb_utils import *
+
+# objset of the worker process, set up by init_worker
+_objset = None
+
+def load_objset(objset_data, config):
+    return DMUObjset(objset_data, VDEVHandler.from_config(config))
+
+def init_worker(opener, cksum, prefetch):
+    global _objset
+    ChecksumPolicy.default = ChecksumPolicy(cksum)
+    if prefetch is not None:
+        Prefetcher.set_default(prefetch)
+    _objset = opener()
+
+def write_sparse(obj, dest, size):
+    """Write the object's data to dest, seeking over holes, cut at size"""
+    prefetch = Prefetcher.get_default()
+    with open(dest, "wb") as f, buffer_pool.buffer(obj.dblk) as out:
+        for blk in obj.iter_extents(out=out, prefetch=prefetch):
+            if isinstance(blk, BlkPtr.Hole):
+                continue
+            off = blk.id * obj.dblk
+            if off >= size:
+                break
+            f.seek(off)
+            f.write(memoryview(blk.buf)[:size - off])
+        f.truncate(size)
+
+def read_all(obj, size):
+    buf = bytearray(size)
+    for blk in obj.iter_blks():
+        off = blk.id * obj.dblk
+        if off < size:
+            buf[off:off + len(blk.buf)] = memoryview(blk.buf)[:size - off]
+    return bytes(buf)
+
+def apply_attrs(dest, attrs):
+    mode = attrs["ZPL_MODE"]
+    if os.geteuid() == 0:
+        os.lchown(dest, attrs["ZPL_UID"], attrs["ZPL_GID"])
+    if not stat.S_ISLNK(mode):
+        os.chmod(dest, stat.S_IMODE(mode))
+    atime, mtime = attrs["ZPL_ATIME"], attrs["ZPL_MTIME"]
+    os.utime(dest, ns=(atime[0] * 1000000000 + atime[1], mtime[0] * 1000000000 + mtime[1]),
+             follow_symlinks=False)
+
+def extract_file(objset, obj_id, dest):
+    """Recreate a non directory object at dest, return the bytes written"""
+    obj, attrs = objset.get_znode(obj_id)
+    mode, size = attrs["ZPL_MODE"], attrs["ZPL_SIZE"]
+    nbytes = 0
+    if stat.S_ISREG(mode):
+        write_sparse(obj, dest, size)
+        nbytes = size
+    elif stat.S_ISLNK(mode):
+        # short targets are kept in the SA, long ones in the data blocks
+        target = attrs.get("ZPL_SYMLINK") or read_all(obj, size)
+        os.symlink(target[:size], dest)
+    elif stat.S_ISFIFO(mode):
+        os.mkfifo(dest)
+    else:
+        rdev = attrs.get("ZPL_RDEV", 0)
+        os.mknod(dest, mode, os.makedev(rdev >> 32, rdev & 0xffffffff))
+    apply_attrs(dest, attrs)
+    return nbytes
+
+def extract_batch(items):
+    nfiles, nbytes, errors = 0, 0, []
+    for obj_id, dest in items:
+        try:
+            nbytes += extract_file(_objset, obj_id, dest)
+            nfiles += 1
+        except Exception as e:
+            errors.append((dest, repr(e)))
+    return nfiles, nbytes, errors
+
+class Extractor:
+    """Recreate a ZPL subtree under a local directory.
+
+    opener is a picklable callable returning the DMUObjset, called here
+    and once in every worker. The walk and the directories are done in
+    this process, files are extracted in batches on a process pool
+    (spawned, each worker opens the vdevs itself) with at most 4 batches
+    per worker in flight.
+    Hard links are recreated once their first name is extracted and
+    directory attributes are applied last, deepest first.
+    """
+    def __init__(self, opener, dest, jobs=None, batch=64, cksum=ChecksumPolicy.VERIFY, prefetch=None):
+        self.opener = opener
+        self.objset = opener()
+        self.dest = dest
+        self.jobs = jobs or os.cpu_count() or 4
+        self.batch = batch
+        self.cksum = cksum
+        self.prefetch = prefetch
+        self.nfiles, self.nbytes, self.errors = 0, 0, []
+        self.start = self.last_report = time.perf_counter()
+
+    def report(self):
+        elapsed = max(time.perf_counter() - self.start, 1e-9)
+        print(f"extract: {self.nfiles} files, {self.nbytes / (1 << 20):.1f} MB in {elapsed:.1f}s, "
+              f"{self.nfiles / elapsed:.1f} files/s, {self.nbytes / (1 << 20) / elapsed:.1f} MB/s"
+              f"{', %d errors' % len(self.errors) if self.errors else ''}", file=sys.stderr)
+        self.last_report = time.perf_counter()
+
+    def collect(self, futures):
+        for future in futures:
+            nfiles, nbytes, errors = future.result()
+            self.nfiles += nfiles
+            self.nbytes += nbytes
+            self.errors.extend(errors)
+        if time.perf_counter() - self.last_report > 5:
+            self.report()
+
+    def run(self, top="/"):
+        top_id = self.objset.lookup(top)
+        assert top_id is not None, f"{top}: no such file or directory"
+        top = "/" + top.strip("/")
+        dirs = [(self.dest, top_id)]
+        links = dict()      # obj id -> first extracted path
+        hardlinks = []
+        pending = set()
+        ctx = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(self.jobs, mp_context=ctx, initializer=init_worker,
+                                 initargs=(self.opener, self.cksum, self.prefetch)) as executor:
+            def submit(items):
+                while len(pending) >= 4 * self.jobs:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    pending.difference_update(done)
+                    self.collect(done)
+                pending.add(executor.submit(extract_batch, items))
+
+            items = []
+            for path, subdirs, files in self.objset.walk(top):
+                ddir = os.path.join(self.dest, os.path.relpath(path, top))
+                os.makedirs(ddir, exist_ok=True)
+                dirs.extend((os.path.join(ddir, ent.name), ent.obj) for ent in subdirs)
+                for ent in files:
+                    dest = os.path.join(ddir, ent.name)
+                    if ent.obj in links:
+                        hardlinks.append((links[ent.obj], dest))
+                        continue
+                    links[ent.obj] = dest
+                    items.append((ent.obj, dest))
+                    if len(items) >= self.batch:
+                        submit(items)
+                        items = []
+            if items:
+                submit(items)
+            self.collect(wait(pending).done)
+        for src, dest in hardlinks:
+            try:
+                os.link(src, dest, follow_symlinks=False)
+            except OSError as e:
+                self.errors.append((dest, repr(e)))
+        for ddir, obj_id in reversed(dirs):
+            try:
+                apply_attrs(ddir, self.objset.get_znode(obj_id)[1])
+            except Exception as e:
+                self.errors.append((ddir, repr(e)))
+        self.report()
+        return self.errors
+
+def parse_arg():
+    parser = argparse.ArgumentParser(description="extract a ZPL subtree to a local directory")
+    parser.add_argument("--file", metavar="objset", help="path to objset data, default is stdin")
+    parser.add_argument("--config", metavar="nvlist.json", default="nvlist.json")
+    parser.add_argument("--path", metavar="/dir", default="/", help="directory in the dataset to extract")
+    parser.add_argument("--dest", metavar="dir", required=True, help="local directory to extract into")
+    parser.add_argument("--jobs", metavar="N", type=int, help="worker processes, default is the number of CPUs")
+    parser.add_argument("--prefetch", metavar="N", type=int, help="number of blocks to read ahead per worker, 0 to disable")
+    parser.add_argument("--cksum", choices=ChecksumPolicy.modes, default=ChecksumPolicy.default.mode, help="checksum verify policy")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_arg()
+    if args.file:
+        buf = open(args.file, "rb").read()
+    else:
+        buf = sys.stdin.buffer.read()
+    ChecksumPolicy.default = ChecksumPolicy(args.cksum)
+    opener = functools.partial(load_objset, buf, os.path.abspath(args.config))
+    extractor = Extractor(opener, args.dest, args.jobs, cksum=args.cksum, prefetch=args.prefetch)
+    errors = extractor.run(args.path)
+    for dest, err in errors:
+        print(f"extract: {dest}: {err}", file=sys.stderr)
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
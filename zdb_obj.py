@@ -1,11 +1,22 @@
 #!/usr/bin/env python3
 
+import functools
+import io
+import multiprocessing
 import struct
-from collections import namedtuple
+import numpy as np
+from collections import namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
 import argparse
-from zdb_blkptr import BlkPtr
+from zdb_blkptr import BlkPtr, BlkPtrArray
+from zdb_vdev import VDEVHandler
+from zdb_checksum import ChecksumPolicy, ChecksumError
+from zdb_compress import buffer_pool, codec_stats
+from zdb_arc import block_cache, DentryCache
+from zdb_prefetch import Prefetcher
 from zdb_utils import *
 from zdb_zap import *
+from zdb_sa import SASchema, ZnodeStatsBuilder, DMU_OT_SA
 from datetime import datetime
 
 def print_zip(alist, blist, indent="\t"):
@@ -84,22 +95,76 @@ def dmutype2name(type_id):
 def get_dump_func(type_id):
     return dmu_ot_info[get_q_id(type_id)][0]
 
+# ZPL directory entries: object id in the low 48 bits, DT_* type in the top 4
+DT_FIFO = 1
+DT_DIR = 4
+DT_REG = 8
+DT_LNK = 10
+
+def zpl_dirent(value):
+    return value & ((1<<48) - 1), value >> 60
+
+Dirent = namedtuple("Dirent", ["name", "obj", "type"])
+
+# objset of a walk worker process, set up by init_walk_worker
+_walk_objset = None
+
+def init_walk_worker(opener, cksum):
+    global _walk_objset
+    ChecksumPolicy.default = ChecksumPolicy(cksum)
+    _walk_objset = opener()
+
+def walk_subtree(path, dir_id, max_dirs):
+    return _walk_objset.read_subtree(path, dir_id, max_dirs)
+
 def get_dn_type(buf):
     return buf[0]
 
-'''same as struct dnode phys'''
+DNODE_SIZE = 512
+DnodePhys = namedtuple("DnodePhys", "dn_type indblkshift nlevels nblkptr bonustype checksum compress flags datablkszsec bonuslen extra_slots maxblkid used")
+dnode_phys_struct = struct.Struct("@8BHHB3xQQ32x")
+DN_EXTRA_SLOTS_OFFSET = 12
+
+'''same as struct dnode phys
+
+Only the buffer is kept at construction, the header, blkptrs and bonus are
+decoded on first access: scanning a dnode array touches most dnodes only
+for their type.
+'''
 class DMUObjectCommon:
-    def __init__(self, data):
+    __slots__ = ("data", "handler", "_prop", "_blkptrs")
+
+    def __init__(self, data, handler=None):
         self.data = data
+        self.handler = handler
         assert len(data) >= 0x200, "buf too small, at least 0x200"
-        names = "dn_type indblkshift nlevels nblkptr bonustype checksum compress flags datablkszsec bonuslen extra_slots maxblkid used"
-        prop = namedtuple("DnodePhys", names)(*struct.unpack("@8BHHB3xQQ32x", data[:64]))
-        self.prop = prop
-        self.iblk = 1 << prop.indblkshift
-        self.dblk = prop.datablkszsec << 9 # 16KB
-        self.bps = self.get_bps(prop.nblkptr)
-        self.block_cache = dict()
-    
+        self._prop = None
+        self._blkptrs = None
+
+    @property
+    def prop(self):
+        if self._prop is None:
+            self._prop = DnodePhys(*dnode_phys_struct.unpack_from(self.data))
+        return self._prop
+
+    @property
+    def iblk(self):
+        return 1 << self.prop.indblkshift
+
+    @property
+    def dblk(self):
+        return self.prop.datablkszsec << 9 # 16KB
+
+    @property
+    def blkptrs(self):
+        if self._blkptrs is None:
+            self._blkptrs = self.get_bps(self.prop.nblkptr)
+        return self._blkptrs
+
+    @property
+    def bps(self):
+        return [bp for bp in self.blkptrs if bp.type != 0]
+
     def iter_my_zap(self):
         buf = self.read_blk(0).buf
         zap = ZapRegistry.get_inst(buf)
@@ -107,9 +172,8 @@ class DMUObjectCommon:
             yield name, value
 
     def get_zap(self, qname):
-        for name, value in self.iter_my_zap():
-            if name == qname:
-                return value
+        buf = self.read_blk(0).buf
+        return ZapRegistry.get_inst(buf).lookup(self, qname)
 
     def dump_raw(self):
         if sys.stdout.isatty():
@@ -117,9 +181,12 @@ class DMUObjectCommon:
         else:
             return std_write(self.data)
 
+    def get_bonus(self):
+        start = 64 + 128 * self.prop.nblkptr
+        return self.data[start:start + self.prop.bonuslen]
+
     def get_bonus_data(self):
-        start = 64 + 128
-        buf = self.data[start:start + self.prop.bonuslen]
+        buf = self.get_bonus()
         debug_print4("========== bonus data ===================", DEBUG_ZFS_OBJECT)
         debug_print4(hexdump(buf), DEBUG_ZFS_OBJECT)
         return buf
@@ -128,30 +195,145 @@ class DMUObjectCommon:
         bps = []
         for i in range(nblkptr):
             start = 64 + i*128
-            bp = BlkPtr(self.data[start:start+128])
-            if bp.prop.type != 0:
-                bps.append(bp)
+            bps.append(BlkPtr(self.data[start:start+128], self.handler))
         return bps
 
-    def read_blk(self, blkid):
-        if blkid in self.block_cache:
-            return self.block_cache[blkid]
+    def blkid_span(self):
+        """number of L0 blocks covered by one of the dnode's blkptrs"""
+        return (self.iblk // BlkPtr.bs) ** (self.prop.nlevels - 1)
 
+    def read_blk(self, blkid, policy=None, out=None):
+        if self.prop.nlevels == 0:
+            return BlkPtr.BlockData(blkid, -1, -1, None)
+        bp = self.blkptrs[blkid // self.blkid_span()]
+        return bp.get_blkdata(blkid, nlevels=self.prop.nlevels, policy=policy, out=out)
+
+    def iter_l0(self, policy=None, holes=False):
+        """Yield (blkid, BlkPtr) of every allocated L0 block in blkid order,
+        reading each indirect block only once. With holes=True unallocated
+        ranges are yielded as (blkid, BlkPtr.Hole)."""
         if self.prop.nlevels == 0:
-            return [-1, -1, None]
-        if self.prop.nlevels == 1:
-            blk_data = self.bps[blkid].get_blkdata(0)
+            return
+        span = self.blkid_span()
+        for i, bp in enumerate(self.blkptrs):
+            yield from bp.iter_l0(i * span, policy, holes, span)
+
+    def iter_blks(self, policy=None, out=None, prefetch=None, batch=None):
+        """Yield the allocated L0 blocks; if out is given blocks may be
+        decompressed into it, so consume each block before the next.
+        With a Prefetcher the next blocks are read ahead (out is ignored).
+        With batch, blocks are fetched batch at a time with coalesced reads."""
+        if batch:
+            def read_batch(items):
+                bufs = BlkPtr.read_data_many([bp for _, bp in items], policy)
+                return [BlkPtr.BlockData(blkid, *(bp.loc or (-1, -1)), buf)
+                        for (blkid, bp), buf in zip(items, bufs)]
+            batches = chunked(self.iter_l0(policy), batch)
+            results = map(read_batch, batches) if prefetch is None else prefetch.map(read_batch, batches)
+            for blocks in results:
+                yield from blocks
+            return
+        if prefetch is None:
+            for blkid, bp in self.iter_l0(policy):
+                yield bp.get_blkdata(blkid, policy=policy, out=out)
+            return
+        read = lambda item: item[1].get_blkdata(item[0], policy=policy)
+        yield from prefetch.map(read, self.iter_l0(policy))
+
+    def iter_ranges(self, policy=None):
+        """Yield (blkid, BlkPtr) for allocated L0 blocks and (blkid,
+        BlkPtr.Hole) for merged unallocated ranges, up to maxblkid."""
+        end = self.prop.maxblkid + 1
+        hole = None
+        for blkid, bp in self.iter_l0(policy, holes=True):
+            if blkid >= end:
+                break
+            if isinstance(bp, BlkPtr.Hole):
+                nblks = min(bp.nblks, end - blkid)
+                if hole is None:
+                    hole = BlkPtr.Hole(blkid, nblks)
+                else:
+                    hole = BlkPtr.Hole(hole.id, hole.nblks + nblks)
+                continue
+            if hole is not None:
+                yield hole.id, hole
+                hole = None
+            yield blkid, bp
+        if hole is not None:
+            yield hole.id, hole
+
+    def iter_extents(self, policy=None, out=None, prefetch=None):
+        """Like iter_blks, but unallocated ranges are yielded as
+        BlkPtr.Hole(id, nblks) so consumers can seek past them."""
+        def read(item):
+            blkid, bp = item
+            if isinstance(bp, BlkPtr.Hole):
+                return bp
+            return bp.get_blkdata(blkid, policy=policy, out=out if prefetch is None else None)
+        if prefetch is None:
+            yield from map(read, self.iter_ranges(policy))
         else:
-            blk_data = self.bps[0].get_blkdata(blkid, nlevels=self.prop.nlevels)
-        self.block_cache[blkid] = blk_data
+            yield from prefetch.map(read, self.iter_ranges(policy))
 
-        return self.block_cache[blkid]
+    def iter_holes(self, policy=None):
+        """Yield (offset, length) in bytes of the unallocated ranges."""
+        for blkid, bp in self.iter_ranges(policy):
+            if isinstance(bp, BlkPtr.Hole):
+                yield bp.id * self.dblk, bp.nblks * self.dblk
 
-    def iter_blks(self):
-        for blkid in range(self.prop.maxblkid + 1):
-            blockdata = self.read_blk(blkid)
-            if blockdata.buf:
-                yield blockdata
+    def blkptr_array(self):
+        return BlkPtrArray(self.data[64:64 + 128 * self.prop.nblkptr], self.handler)
+
+    def iter_arrays(self, policy=None):
+        """Yield (lvl, blkid, BlkPtrArray) for the dnode's own blkptrs and
+        then every indirect block of the tree, depth-first."""
+        if self.prop.nlevels == 0:
+            return
+        span = self.blkid_span()
+        top = self.blkptr_array()
+        yield self.prop.nlevels - 1, 0, top
+        for i in np.flatnonzero(~top.holes()):
+            yield from top[int(i)].iter_arrays(int(i) * span, policy)
+
+    def block_stats(self, policy=None):
+        """{lvl: [count, lsize, psize, asize]} of the allocated blocks"""
+        stats = dict()
+        for lvl, _, bps in self.iter_arrays(policy):
+            st = stats.setdefault(lvl, [0, 0, 0, 0])
+            for i, value in enumerate(bps.stats()):
+                st[i] += value
+        return stats
+
+    def show_block_stats(self, policy=None):
+        for lvl, (cnt, lsize, psize, asize) in sorted(self.block_stats(policy).items(), reverse=True):
+            print(f"\tL{lvl}: {cnt} blocks, {lsize:#x}L/{psize:#x}P/{asize:#x}A")
+
+    def scrub(self, policy=None, batch=64):
+        """Verify the checksum of every L0 block, bypassing the block cache.
+        Reads are issued per indirect block in disk offset order. Returns
+        (blocks, bytes, repaired, errors), errors being a list of
+        (blkid, BlkPtr, ChecksumError)."""
+        if policy is None:
+            policy = ChecksumPolicy()
+        nblks, nbytes, repaired, errors = 0, 0, 0, []
+        for lvl, blkid, bps in self.iter_arrays(policy):
+            if lvl != 0:
+                continue
+            for idx in chunked(bps.by_offset(), batch):
+                reqs = [(int(bps.vdev[i]), int(bps.offset[i]), int(bps.psize[i])) for i in idx]
+                items = bps.bps(idx)
+                for i, bp, raw_buf in zip(idx, items, items[0].get_handler().read_many(reqs)):
+                    nblks += 1
+                    nbytes += len(raw_buf)
+                    try:
+                        bp.verify(raw_buf, policy)
+                    except ChecksumError as e:
+                        try:
+                            bp.read_alternate(e)
+                            repaired += 1
+                        except ChecksumError:
+                            errors.append((blkid + int(i), bp, e))
+        return nblks, nbytes, repaired, errors
 
     def __repr__(self):
         return f"{dmutype2name(self.prop.dn_type)}"
@@ -167,11 +349,81 @@ class DMUObjectCommon:
 
         return info
 
+class DMUObjectReader(io.RawIOBase):
+    """Random access reader over the data of an object.
+
+    Byte offsets map to blkids, so a read only fetches the indirect and L0
+    blocks under the requested range (through the block cache); holes read
+    as zeros. size defaults to the ZPL size for SA znodes and to
+    (maxblkid + 1) * dblk otherwise.
+    """
+    def __init__(self, obj, size=None):
+        super().__init__()
+        self.obj = obj
+        if size is None:
+            size = obj.get_size()
+        self.size = size
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self.pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self.pos + offset
+        elif whence == io.SEEK_END:
+            pos = self.size + offset
+        else:
+            raise ValueError(f"invalid whence {whence}")
+        if pos < 0:
+            raise ValueError(f"negative seek position {pos}")
+        self.pos = pos
+        return pos
+
+    def readinto(self, b):
+        view = memoryview(b).cast("B")
+        dblk = self.obj.dblk
+        want = max(0, min(len(view), self.size - self.pos))
+        done = 0
+        while done < want:
+            blkid, off = divmod(self.pos + done, dblk)
+            n = min(want - done, dblk - off)
+            buf = None
+            if blkid <= self.obj.prop.maxblkid:
+                buf = self.obj.read_blk(blkid).buf
+            if buf is None:
+                view[done:done + n] = bytes(n)
+            else:
+                view[done:done + n] = memoryview(buf)[off:off + n]
+            done += n
+        self.pos += done
+        return done
+
 class DMUObject(DMUObjectCommon):
+    __slots__ = ("os",)
+
     def __init__(self, objset, data):
-        super().__init__(data)
+        super().__init__(data, objset.handler)
         self.os = objset
 
+    def get_size(self):
+        """ZPL size of a SA znode, the allocated size for other objects"""
+        if self.prop.bonustype == DMU_OT_SA and self.prop.bonuslen > 0:
+            return self.os.sa_schema.decode(self.get_bonus())["ZPL_SIZE"]
+        return (self.prop.maxblkid + 1) * self.dblk
+
+    def open(self, size=None):
+        """buffered, seekable file object over the object's data"""
+        return io.BufferedReader(DMUObjectReader(self, size), max(self.dblk, io.DEFAULT_BUFFER_SIZE))
+
     def dump_none(self, buf=None):
         pass
 
@@ -185,8 +437,7 @@ class DMUObject(DMUObjectCommon):
 
     def dump_zpldir(self, buf=None):
         for name, value in self.iter_my_zap():
-            obj_id = value & ((1<<48) - 1)
-            file_type = value >> 60
+            obj_id, file_type = zpl_dirent(value)
             print(f"\t{name} = {obj_id} (type: {file_type})")
 
     def dump_znode(self, buf=None):
@@ -216,16 +467,23 @@ class DMUObject(DMUObjectCommon):
         
     def dump_uint8(self, buf=None):
         debug_print1("=========== raw_data start ============", DEBUG_ZFS_OBJECT)
-        for blk in self.iter_blks():
-            debug_print4(f"Dump_uint8: Fetching {blk.vdev}:{blk.offset:x}:{len(blk.buf):x}", DEBUG_ZFS_OBJECT)
-            std_write(blk.buf)
+        prefetch = Prefetcher.get_default()
+        with buffer_pool.buffer(self.dblk) as out:
+            for blk in self.iter_extents(out=out, prefetch=prefetch):
+                if isinstance(blk, BlkPtr.Hole):
+                    debug_print4(f"Dump_uint8: Hole {blk.id}+{blk.nblks}", DEBUG_ZFS_OBJECT)
+                    std_skip(blk.nblks * self.dblk)
+                    continue
+                debug_print4(f"Dump_uint8: Fetching {blk.vdev}:{blk.offset:x}:{len(blk.buf):x}", DEBUG_ZFS_OBJECT)
+                std_write(blk.buf)
+        std_truncate()
         debug_print1("=========== raw_data end ============", DEBUG_ZFS_OBJECT)
 
     def dump_dsl_dataset(self, buf=None):
         names = "dir_obj prev_snap_obj prev_snap_txg next_snap_obj snapnames_zapobj num_children userrefs_obj creation_time creation_txg deadlist_obj used_bytes compressed_bytes uncompressed_bytes unique fsid_guid guid flags next_clones_obj props_obj".split()
         values = struct.unpack_from("16Q128x3Q", buf)
         print_zip(names, values)
-        print(f"\tbp = {BlkPtr(buf[128:128+128]).desc()}")
+        print(f"\tbp = {BlkPtr(buf[128:128+128], self.handler).desc()}")
         self.dump_zap()
 
     def get_dump_func(self, dn_type):
@@ -267,10 +525,10 @@ class DMUObjset(DMUObjectCommon):
     SA_STD = [
         ["ZPL_UID", "uid", int],
         ["ZPL_GID", "gid", int],
-        ["ZPL_ATIME", "atime", lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S")],
-        ["ZPL_MTIME", "mtime", lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S")],
-        ["ZPL_CTIME", "ctime", lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S")],
-        ["ZPL_CRTIME", "crtime", lambda x: datetime.fromtimestamp(x).strftime("%Y-%m-%d %H:%M:%S")],
+        ["ZPL_ATIME", "atime", lambda x: datetime.fromtimestamp(x[0]).strftime("%Y-%m-%d %H:%M:%S")],
+        ["ZPL_MTIME", "mtime", lambda x: datetime.fromtimestamp(x[0]).strftime("%Y-%m-%d %H:%M:%S")],
+        ["ZPL_CTIME", "ctime", lambda x: datetime.fromtimestamp(x[0]).strftime("%Y-%m-%d %H:%M:%S")],
+        ["ZPL_CRTIME", "crtime", lambda x: datetime.fromtimestamp(x[0]).strftime("%Y-%m-%d %H:%M:%S")],
         ["ZPL_GEN", "gen", int],
         ["ZPL_MODE", "mode", get_mode],
         ["ZPL_SIZE",  "size", int],
@@ -278,38 +536,151 @@ class DMUObjset(DMUObjectCommon):
         ["ZPL_LINKS", "links", int],
     ]
 
-    def __init__(self, data):
-        super().__init__(data)
+    def __init__(self, data, handler=None):
+        super().__init__(data, handler)
+        self._sa_schema = None
+        self._root_id = None
+        self.dentry_cache = DentryCache(int(os.environ.get("ZDB_DENTRY_MAX", 1 << 16)))
+
+    @property
+    def root_id(self):
+        """object id of the ZPL root directory, from the master node"""
+        if self._root_id is None:
+            self._root_id = self.get_object(1).get_zap("ROOT")
+            assert self._root_id is not None, "objset: no ROOT in master node"
+        return self._root_id
+
+    def lookup_entry(self, dir_id, name):
+        """(obj_id, type) of name in directory dir_id, None if missing"""
+        ent = self.dentry_cache.get(dir_id, name)
+        if ent is None:
+            value = self.get_object(dir_id).get_zap(name)
+            if value is None:
+                return None
+            ent = zpl_dirent(value)
+            self.dentry_cache.put(dir_id, name, ent)
+        return ent
+
+    def lookup(self, path):
+        """Resolve an absolute path from the ZPL root to an object id, None
+        if a component is missing or not a directory. ".." is resolved
+        lexically."""
+        stack = [(self.root_id, DT_DIR)]
+        for name in path.split("/"):
+            if name in ("", "."):
+                continue
+            if name == "..":
+                if len(stack) > 1:
+                    stack.pop()
+                continue
+            dir_id, dir_type = stack[-1]
+            if dir_type != DT_DIR:
+                return None
+            ent = self.lookup_entry(dir_id, name)
+            if ent is None:
+                return None
+            stack.append(ent)
+        return stack[-1][0]
+
+    @property
+    def sa_schema(self):
+        """SA registry and layouts, read once per objset"""
+        if self._sa_schema is None:
+            self._sa_schema = SASchema(self)
+        return self._sa_schema
 
     def get_znode_attr(self, znode_buf):
-        sa_obj_id = self.get_object(1).get_zap("SA_ATTRS")
-        sa_master = self.get_object(sa_obj_id)
-        registry_id = sa_master.get_zap("REGISTRY")
-        layouts_id = sa_master.get_zap("LAYOUTS")
-        self.sa_name_dict = dict()
-        self.sa_attr_dict = dict()
-        self.layouts = dict()
-        for name, value, attr_num, attr_bswap, attr_length in self.get_object(registry_id).iter_sa_attr():
-            self.sa_name_dict[name] = [attr_bswap, attr_length, value]
-            self.sa_attr_dict[attr_num] = [name, attr_bswap, attr_length, value]
-
-        for name, layouts in self.get_object(layouts_id).iter_my_zap():
-            self.layouts[name] = layouts
-        magic, layout, size = struct.unpack_from("IHH", znode_buf)
-        assert magic == 0x2f505a
-        hdrsz = (layout >> 10)*8
-        layout_id = f"{layout & ((1<<10) - 1)}"
-        off = 8
-        attrs = dict()
-        for attr_num in self.layouts[layout_id]:
-            attr_length = self.sa_attr_dict[attr_num][-2]
-            attr_name = self.sa_attr_dict[attr_num][0]
-            value = struct.unpack_from("Q", znode_buf, off)[0]
-            attrs[attr_name] = value
-            off = off + attr_length
+        attrs = self.sa_schema.decode(znode_buf)
         for name, desc, func in self.SA_STD:
-            print(f"\t{desc}\t{func(attrs[name])}")
-
+            if name in attrs:
+                print(f"\t{desc}\t{func(attrs[name])}")
+
+    def get_znode(self, obj_id):
+        """(DMUObject, SA attrs dict) of a ZPL object"""
+        obj = self.get_object(obj_id)
+        assert obj.prop.bonustype == DMU_OT_SA, f"object {obj_id}: bonus type {obj.prop.bonustype} is not SA"
+        return obj, self.sa_schema.decode(obj.get_bonus())
+
+    def open(self, path):
+        """open a ZPL file by path, see DMUObject.open"""
+        obj_id = self.lookup(path)
+        if obj_id is None:
+            raise FileNotFoundError(path)
+        return self.get_object(obj_id).open()
+
+    def read_dir(self, dir_id):
+        """(dirs, files) of a directory as lists of Dirent"""
+        dirs, files = [], []
+        for name, value in self.get_object(dir_id).iter_my_zap():
+            ent = Dirent(name, *zpl_dirent(value))
+            (dirs if ent.type == DT_DIR else files).append(ent)
+        return dirs, files
+
+    def read_subtree(self, path, dir_id, max_dirs):
+        """Read up to max_dirs directories of the subtree at path, depth
+        first: ([(path, dirs, files)] parents first, [(path, dir_id)] of
+        the subdirectories left unread, as a stack)"""
+        todo, listings = [(path, dir_id)], []
+        while todo and len(listings) < max_dirs:
+            path, dir_id = todo.pop()
+            dirs, files = self.read_dir(dir_id)
+            listings.append((path, dirs, files))
+            for ent in reversed(dirs):
+                todo.append((path.rstrip("/") + "/" + ent.name, ent.obj))
+        return listings, todo
+
+    def walk(self, top="/", workers=None, window=None, opener=None, chunk=64):
+        """os.walk() over the ZPL tree: yield (path, dirs, files) with dirs
+        and files lists of Dirent, parents before their children.
+
+        By default directories are read on a thread pool, which overlaps
+        the block reads, but ZAP entries are decoded in Python under the
+        GIL. With opener, a picklable callable returning this objset (see
+        zdb_extract.Extractor), subtrees of up to chunk directories are
+        listed on a pool of spawned processes that each open the objset,
+        so decoding scales with the cores.
+        At most window reads are in flight. Subdirectories not yet
+        submitted wait on a stack, so the walk goes depth first and memory
+        follows the tree depth rather than its width.
+        """
+        top_id = self.lookup(top)
+        if top_id is None:
+            return
+        workers = workers or int(os.environ.get("ZDB_WALK_THREADS", os.cpu_count() or 4))
+        window = window or 2 * workers
+        todo = [("/" + top.strip("/") if top.strip("/") else "/", top_id)]
+        pending = deque()
+        if opener is None:
+            executor = ThreadPoolExecutor(workers, thread_name_prefix="zdb_walk")
+            read = functools.partial(self.read_subtree, max_dirs=1)
+        else:
+            executor = ProcessPoolExecutor(workers, mp_context=multiprocessing.get_context("spawn"),
+                                           initializer=init_walk_worker,
+                                           initargs=(opener, ChecksumPolicy.default.mode))
+            read = functools.partial(walk_subtree, max_dirs=chunk)
+        with executor:
+            try:
+                while todo or pending:
+                    while todo and len(pending) < window:
+                        path, dir_id = todo.pop()
+                        pending.append(executor.submit(read, path, dir_id))
+                    listings, unread = pending.popleft().result()
+                    yield from listings
+                    todo.extend(unread)
+            finally:
+                for future in pending:
+                    future.cancel()
+
+    def stat_all(self):
+        """uid/gid/mode/size/links/parent/gen and times (ns) of every znode
+        with a SA bonus, as a ZnodeStats of NumPy int64 columns."""
+        stats = ZnodeStatsBuilder(self.sa_schema)
+        for obj_id, obj in self.iter_objects():
+            prop = obj.prop
+            if prop.bonustype != DMU_OT_SA or prop.bonuslen == 0:
+                continue
+            stats.add(obj_id, obj.get_bonus())
+        return stats.result()
 
     def dump_object(self, object_id, raw=False):
         obj = self.get_object(object_id)
@@ -333,21 +704,29 @@ class DMUObjset(DMUObjectCommon):
         return objset_type
 
     def get_object(self, obj_id):
-        obj_per_blk = 32
+        obj_per_blk = self.dblk // DNODE_SIZE
         blkid = obj_id // obj_per_blk
-        obj_offset = (obj_id % obj_per_blk) * 512
-        blockdata = self.read_blk(blkid).buf
-        buf = blockdata[obj_offset:obj_offset + 512]
-        return DMUObject(self, buf)
+        obj_offset = (obj_id % obj_per_blk) * DNODE_SIZE
+        blockdata = memoryview(self.read_blk(blkid).buf)
+        # large dnodes take 1 + extra_slots slots
+        size = (1 + blockdata[obj_offset + DN_EXTRA_SLOTS_OFFSET]) * DNODE_SIZE
+        return DMUObject(self, blockdata[obj_offset:obj_offset + size])
 
     def iter_objects(self):
-        obj_per_blk = 32
-        for blockdata in self.iter_blks():
+        obj_per_blk = self.dblk // DNODE_SIZE
+        for blockdata in self.iter_blks(prefetch=Prefetcher.get_default(), batch=8):
             obj_id = blockdata.id * obj_per_blk
-            for i in range(obj_per_blk):
-                obj = DMUObject(self, blockdata.buf[i*512:i*512+512])
-                if obj.prop.dn_type != 0:
-                    yield obj_id + i, obj
+            buf = memoryview(blockdata.buf)
+            i = 0
+            while i < obj_per_blk:
+                off = i * DNODE_SIZE
+                # check the type byte before building anything
+                if buf[off] == 0:
+                    i += 1
+                    continue
+                slots = 1 + buf[off + DN_EXTRA_SLOTS_OFFSET]
+                yield obj_id + i, DMUObject(self, buf[off:off + slots * DNODE_SIZE])
+                i += slots
 
 # This script always starts from objset,
 # as dump other objects also depends on objset itself.
@@ -360,8 +739,17 @@ class DMUObjset(DMUObjectCommon):
 def parse_arg():
     parser = argparse.ArgumentParser()
     parser.add_argument("--file", metavar="mos", help="path to objset data, default is stdin")
+    parser.add_argument("--config", metavar="nvlist.json", default="nvlist.json")
     parser.add_argument("--obj_id", metavar="0", help="object id, default 0 is objset itself", type=int, default=0)
+    parser.add_argument("--path", metavar="/dir/file", help="ZPL path of the object, instead of --obj_id")
+    parser.add_argument("--walk", help="list every file under --path (default /) with object id and type", action='store_true')
     parser.add_argument("--raw", help="dump as raw data", action='store_true')
+    parser.add_argument("--stats", help="print decompression and block cache stats to stderr", action='store_true')
+    parser.add_argument("--blkstats", help="print per level block counts and sizes of the object", action='store_true')
+    parser.add_argument("--stat_all", help="print uid/gid/mode/size/mtime of every znode, tab separated", action='store_true')
+    parser.add_argument("--scrub", help="verify the checksum of every data block of the object", action='store_true')
+    parser.add_argument("--prefetch", metavar="N", type=int, help="number of blocks to read ahead, 0 to disable")
+    parser.add_argument("--cksum", choices=ChecksumPolicy.modes, default=ChecksumPolicy.default.mode, help="checksum verify policy")
     args = parser.parse_args()
     return args
 
@@ -375,7 +763,42 @@ def main():
         debug_print0(f"Reading object from stdin", DEBUG_ZFS_OBJECT)
         buf = sys.stdin.buffer.read()
 
-    return DMUObjset(buf).dump(args.obj_id, args.raw)
+    ChecksumPolicy.default = ChecksumPolicy(args.cksum)
+    if args.prefetch is not None:
+        Prefetcher.set_default(args.prefetch)
+    handler = VDEVHandler.from_config(args.config)
+    objset = DMUObjset(buf, handler)
+    if args.walk:
+        for path, dirs, files in objset.walk(args.path or "/"):
+            for ent in dirs + files:
+                print(f"{path.rstrip('/')}/{ent.name}\t{ent.obj}\t{ent.type}")
+        return
+    if args.path:
+        args.obj_id = objset.lookup(args.path)
+        assert args.obj_id is not None, f"{args.path}: no such file or directory"
+    if args.stat_all:
+        st = objset.stat_all()
+        print("obj\tmode\tuid\tgid\tsize\tmtime")
+        for row in zip(st.obj, st.mode, st.uid, st.gid, st.size, st.mtime // 1000000000):
+            print("\t".join([str(row[0]), get_mode(int(row[1]))] + [str(x) for x in row[2:]]))
+        ret = None
+    elif args.blkstats or args.scrub:
+        obj = objset if args.obj_id == 0 else objset.get_object(args.obj_id)
+        if args.blkstats:
+            obj.show_block_stats()
+        if args.scrub:
+            nblks, nbytes, repaired, errors = obj.scrub()
+            print(f"\tscrub: {nblks} blocks, {nbytes:#x} bytes, {repaired} repaired, {len(errors)} errors")
+            for blkid, bp, e in errors:
+                print(f"\t  blkid {blkid} {bp}: {e}")
+        ret = None
+    else:
+        ret = objset.dump(args.obj_id, args.raw)
+    if args.stats:
+        codec_stats.dump()
+        block_cache.dump()
+        objset.dentry_cache.dump()
+    return ret
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+import argparse
+import copy
+import functools
+import os
+import shutil
+import struct
+from collections import namedtuple
+from zdb_label import Label
+from zdb_blkptr import BlkPtr
+from zdb_vdev import VDEVHandler
+from zdb_checksum import ChecksumPolicy, ChecksumRegistry
+from zdb_compress import codec_stats
+from zdb_arc import block_cache
+from zdb_prefetch import Prefetcher
+from zdb_obj import DMUObjset
+from zdb_utils import *
+
+UBERBLOCK_MAGIC = 0xbab10c
+# MOS object directory, DMU_POOL_DIRECTORY_OBJECT
+DMU_POOL_DIRECTORY_OBJECT = 1
+DMU_POOL_ROOT_DATASET = "root_dataset"
+DMU_POOL_CHECKSUM_SALT = "org.illumos:checksum_salt"
+
+DSLDir = namedtuple("DSLDir", "creation_time head_dataset_obj parent_dir_obj origin_obj child_dir_zapobj")
+DSLDataset = namedtuple("DSLDataset", "dir_obj prev_snap_obj prev_snap_txg next_snap_obj snapnames_zapobj")
+
+def relocate(vdev_tree, paths):
+    """point the leaves of vdev_tree whose guid is in paths at the given devices"""
+    if vdev_tree.get("guid") in paths:
+        vdev_tree["path"] = paths[vdev_tree["guid"]]
+    for child in vdev_tree.get("children", []):
+        relocate(child, paths)
+
+class Pool:
+    """A pool opened from its devices, everything in one process.
+
+    The vdev config comes from the device labels (leaf paths replaced by
+    the devices given), the active uberblock is the valid one with the
+    highest txg (or the given txg). From its rootbp the MOS is read, then
+    object directory -> root_dataset DSL dir -> child_dir_zapobj ->
+    head dataset -> objset. All objsets share one VDEVHandler and the
+    process-wide block cache.
+    """
+    def __init__(self, devs, txg=None):
+        self.devs = list(devs)
+        self.labels = [Label(dev) for dev in self.devs]
+        paths = {label.get_nvlist()["guid"]: os.path.abspath(dev) for label, dev in zip(self.labels, self.devs)}
+        self.config = []
+        for label in self.labels:
+            nv_config = copy.deepcopy(label.get_nvlist())
+            relocate(nv_config["vdev_tree"], paths)
+            self.config.append(nv_config)
+        self.name = self.config[0]["name"]
+        self.handler = VDEVHandler(self.config)
+        self.uberblock = self.select_uberblock(txg)
+        debug_print0(f"Pool {self.name}: txg {self.uberblock.txg}, rootbp {self.uberblock.blkptr}", DEBUG_ZFS_OBJECT)
+        self.rootbp = BlkPtr(self.uberblock.blkptr.data, self.handler)
+        self.mos = DMUObjset(self.rootbp.read_data(), self.handler)
+        self.objdir = self.mos.get_object(DMU_POOL_DIRECTORY_OBJECT)
+        salt = self.objdir.get_zap(DMU_POOL_CHECKSUM_SALT)
+        if salt is not None:
+            ChecksumRegistry.salt = bytes(salt)
+        self.objsets = dict()
+
+    def select_uberblock(self, txg=None):
+        ubs = [ub for label in self.labels for ub in label.ublist.ublist
+               if ub.magic == UBERBLOCK_MAGIC and (txg is None or ub.txg == txg)]
+        assert ubs, f"Pool: no valid uberblock{'' if txg is None else f' for txg {txg}'}"
+        return max(ubs, key=lambda ub: (ub.txg, ub.ts))
+
+    def get_dsl_dir(self, dir_obj):
+        bonus = self.mos.get_object(dir_obj).get_bonus()
+        return DSLDir(*struct.unpack_from("5Q", bonus))
+
+    def get_dsl_dataset(self, ds_obj):
+        bonus = self.mos.get_object(ds_obj).get_bonus()
+        return DSLDataset(*struct.unpack_from("5Q", bonus)), BlkPtr(bonus[128:256], self.handler)
+
+    def iter_dirs(self, dir_obj=None, name=None):
+        """Yield (name, DSL dir obj) of every dataset, parents first"""
+        if dir_obj is None:
+            dir_obj, name = self.mos.get_object(DMU_POOL_DIRECTORY_OBJECT).get_zap(DMU_POOL_ROOT_DATASET), self.name
+        yield name, dir_obj
+        dsl_dir = self.get_dsl_dir(dir_obj)
+        if dsl_dir.child_dir_zapobj == 0:
+            return
+        children = sorted(self.mos.get_object(dsl_dir.child_dir_zapobj).iter_my_zap())
+        for child, child_obj in children:
+            # $MOS, $FREE and $ORIGIN are internal
+            if not child.startswith("$"):
+                yield from self.iter_dirs(child_obj, f"{name}/{child}")
+
+    def lookup_dataset(self, name):
+        """dataset object of "pool/fs/child[@snap]", None if missing"""
+        name, _, snap = name.partition("@")
+        parts = name.split("/")
+        assert parts[0] == self.name, f"Pool: {name} is not in pool {self.name}"
+        dir_obj = self.objdir.get_zap(DMU_POOL_ROOT_DATASET)
+        for part in parts[1:]:
+            child_zap = self.get_dsl_dir(dir_obj).child_dir_zapobj
+            dir_obj = self.mos.get_object(child_zap).get_zap(part) if child_zap else None
+            if dir_obj is None:
+                return None
+        ds_obj = self.get_dsl_dir(dir_obj).head_dataset_obj
+        if snap:
+            snapnames = self.get_dsl_dataset(ds_obj)[0].snapnames_zapobj
+            ds_obj = self.mos.get_object(snapnames).get_zap(snap) if snapnames else None
+        return ds_obj
+
+    def open_objset(self, name):
+        """DMUObjset of a dataset or snapshot, kept for the life of the pool"""
+        objset = self.objsets.get(name)
+        if objset is None:
+            ds_obj = self.lookup_dataset(name)
+            assert ds_obj is not None, f"Pool: no dataset {name}"
+            bp = self.get_dsl_dataset(ds_obj)[1]
+            objset = DMUObjset(bp.read_data(), self.handler)
+            self.objsets[name] = objset
+        return objset
+
+    def close(self):
+        self.handler.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+def open_pool_objset(devs, txg, name):
+    """Extractor opener: the objset of dataset name, or the MOS if None"""
+    pool = Pool(devs, txg)
+    return pool.open_objset(name) if name else pool.mos
+
+def parse_arg():
+    parser = argparse.ArgumentParser(description="open a pool from its devices and explore it")
+    parser.add_argument("--dev", nargs="+", required=True, help="devices or image files of the pool")
+    parser.add_argument("--txg", type=int, help="use the uberblock of this txg instead of the latest")
+    parser.add_argument("--dataset", metavar="pool/fs[@snap]", help="dataset to work on, default is the MOS")
+    parser.add_argument("--list", help="list the datasets", action='store_true')
+    parser.add_argument("--obj_id", metavar="0", type=int, default=0, help="object id, default 0 is objset itself")
+    parser.add_argument("--path", metavar="/dir/file", help="ZPL path of the object, instead of --obj_id")
+    parser.add_argument("--raw", help="dump as raw data", action='store_true')
+    parser.add_argument("--cat", help="write the data of --path to stdout", action='store_true')
+    parser.add_argument("--walk", help="list every file under --path (default /)", action='store_true')
+    parser.add_argument("--extract", metavar="dir", help="extract --path (default /) into dir")
+    parser.add_argument("--jobs", metavar="N", type=int, help="worker processes for --extract and --walk")
+    parser.add_argument("--stats", help="print decompression and block cache stats to stderr", action='store_true')
+    parser.add_argument("--prefetch", metavar="N", type=int, help="number of blocks to read ahead, 0 to disable")
+    parser.add_argument("--cksum", choices=ChecksumPolicy.modes, default=ChecksumPolicy.default.mode, help="checksum verify policy")
+    args = parser.parse_args()
+    return args
+
+def main():
+    args = parse_arg()
+    ChecksumPolicy.default = ChecksumPolicy(args.cksum)
+    if args.prefetch is not None:
+        Prefetcher.set_default(args.prefetch)
+    with Pool(args.dev, args.txg) as pool:
+        if args.list:
+            for name, dir_obj in pool.iter_dirs():
+                ds_obj = pool.get_dsl_dir(dir_obj).head_dataset_obj
+                bp = pool.get_dsl_dataset(ds_obj)[1] if ds_obj else None
+                print(f"{name}\tdir {dir_obj}\tdataset {ds_obj}\t{bp}")
+            return
+        objset = pool.open_objset(args.dataset) if args.dataset else pool.mos
+        devs = [os.path.abspath(dev) for dev in args.dev]
+        opener = functools.partial(open_pool_objset, devs, pool.uberblock.txg, args.dataset)
+        if args.extract:
+            from zdb_extract import Extractor
+            errors = Extractor(opener, args.extract, args.jobs, cksum=args.cksum,
+                               prefetch=args.prefetch).run(args.path or "/")
+            for dest, err in errors:
+                print(f"extract: {dest}: {err}", file=sys.stderr)
+        elif args.walk:
+            # listed on worker processes with --jobs, threads otherwise
+            walk_opener = opener if args.jobs else None
+            for path, dirs, files in objset.walk(args.path or "/", args.jobs, opener=walk_opener):
+                for ent in dirs + files:
+                    print(f"{path.rstrip('/')}/{ent.name}\t{ent.obj}\t{ent.type}")
+        elif args.cat:
+            with objset.open(args.path) as f:
+                shutil.copyfileobj(f, sys.stdout.buffer)
+        else:
+            obj_id = args.obj_id
+            if args.path:
+                obj_id = objset.lookup(args.path)
+                assert obj_id is not None, f"{args.path}: no such file or directory"
+            objset.dump(obj_id, args.raw)
+        if args.stats:
+            codec_stats.dump()
+            block_cache.dump()
+
+if __name__ == '__main__':
+    main()
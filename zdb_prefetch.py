@@ -0,0 +1,60 @@
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from zdb_utils import *
+
+class Prefetcher:
+    """Read-ahead on a thread pool.
+
+    map() runs func over items with at most window calls in flight and
+    yields the results in item order. Items are only pulled from the input
+    when a slot frees up, so a slow consumer stops the read-ahead and at
+    most window results are held in memory.
+    """
+    default = None
+    # default stays None when read-ahead is disabled, so track separately
+    # whether it has been set up
+    default_configured = False
+    default_lock = threading.Lock()
+
+    def __init__(self, window=16, workers=None):
+        self.window = max(1, window)
+        self.executor = ThreadPoolExecutor(workers or self.window, thread_name_prefix="zdb_prefetch")
+
+    @classmethod
+    def get_default(cls):
+        """Process-wide prefetcher, window from ZDB_PREFETCH; None if
+        read-ahead is disabled (ZDB_PREFETCH <= 1)."""
+        with cls.default_lock:
+            if not cls.default_configured:
+                window = int(os.environ.get("ZDB_PREFETCH", 16))
+                cls.default = cls(window) if window > 1 else None
+                cls.default_configured = True
+            return cls.default
+
+    @classmethod
+    def set_default(cls, window):
+        with cls.default_lock:
+            if cls.default is not None:
+                cls.default.shutdown()
+            cls.default = cls(window) if window > 1 else None
+            cls.default_configured = True
+
+    def map(self, func, items):
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(self.executor.submit(func, item))
+                if len(pending) >= self.window:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            if pending:
+                debug_print2(f"prefetch: drop {len(pending)} pending reads", DEBUG_ZFS_PREFETCH)
+            for future in pending:
+                future.cancel()
+
+    def shutdown(self):
+        self.executor.shutdown(wait=True, cancel_futures=True)
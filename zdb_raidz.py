@@ -0,0 +1,99 @@
+import numpy as np
+
+# GF(2^8) with the RAID-Z polynomial x^8 + x^4 + x^3 + x^2 + 1 (0x11d),
+# generator 2, same field as vdev_raidz_math
+GF_EXP = np.zeros(512, dtype=np.uint8)
+GF_LOG = np.zeros(256, dtype=np.int32)
+
+def _init_tables():
+    x = 1
+    for i in range(255):
+        GF_EXP[i] = x
+        GF_LOG[x] = i
+        x <<= 1
+        if x & 0x100:
+            x ^= 0x11d
+    GF_EXP[255:510] = GF_EXP[:255]
+
+_init_tables()
+
+def gf_mul(a, b):
+    if a == 0 or b == 0:
+        return 0
+    return int(GF_EXP[GF_LOG[a] + GF_LOG[b]])
+
+def gf_inv(a):
+    assert a != 0, "GF(2^8): 0 has no inverse"
+    return int(GF_EXP[255 - GF_LOG[a]])
+
+def gf_pow2(p, k):
+    """(2^p)^k, the coefficient of data column k places from the end in
+    parity column p (P: 1, Q: 2^k, R: 4^k)"""
+    return int(GF_EXP[(p * k) % 255])
+
+# GF_MUL[c] maps every byte x to c * x, so multiplying a whole column by a
+# constant is one table lookup
+GF_MUL = np.zeros((256, 256), dtype=np.uint8)
+for _c in range(1, 256):
+    GF_MUL[_c] = GF_EXP[GF_LOG[_c] + GF_LOG[np.arange(256)]]
+    GF_MUL[_c][0] = 0
+
+def gen_parity(data_cols, nparity, size):
+    """P, Q and R (the first nparity of them) over the data columns, each
+    zero padded to size bytes."""
+    parity = [np.zeros(size, dtype=np.uint8) for _ in range(nparity)]
+    for col in data_cols:
+        col = np.frombuffer(col, dtype=np.uint8)
+        for p in range(nparity):
+            acc = parity[p]
+            if p > 0:
+                # Horner: acc = acc * 2^p ^ col
+                acc = GF_MUL[gf_pow2(p, 1)][acc]
+            acc[:len(col)] ^= col
+            parity[p] = acc
+    return parity
+
+def gf_solve(matrix):
+    """Invert a small square matrix over GF(2^8) (Gauss-Jordan)."""
+    n = len(matrix)
+    m = [list(row) + [int(i == j) for j in range(n)] for i, row in enumerate(matrix)]
+    for col in range(n):
+        pivot = next(r for r in range(col, n) if m[r][col] != 0)
+        m[col], m[pivot] = m[pivot], m[col]
+        inv = gf_inv(m[col][col])
+        m[col] = [gf_mul(inv, x) for x in m[col]]
+        for r in range(n):
+            if r != col and m[r][col] != 0:
+                f = m[r][col]
+                m[r] = [x ^ gf_mul(f, y) for x, y in zip(m[r], m[col])]
+    return [row[n:] for row in m]
+
+def reconstruct(parity_cols, data_cols, missing, sizes):
+    """Rebuild the data columns listed in missing.
+
+    parity_cols: P/Q/R columns (None if unreadable), data_cols: data
+    columns (missing ones are ignored), sizes: size of every data column.
+    Returns the list of data columns with the missing ones filled in.
+    """
+    nparity = len(parity_cols)
+    ndata = len(data_cols)
+    size = max(len(p) for p in parity_cols if p is not None)
+    avail = [p for p in range(nparity) if parity_cols[p] is not None]
+    assert len(missing) <= len(avail), f"raidz: can't rebuild {len(missing)} columns from {len(avail)} parity"
+    rows = avail[:len(missing)]
+
+    # syndromes: parity of the surviving columns xor the stored parity
+    known = [col if j not in missing else b'' for j, col in enumerate(data_cols)]
+    partial = gen_parity(known, nparity, size)
+    syndromes = [partial[p] ^ np.frombuffer(parity_cols[p], dtype=np.uint8) for p in rows]
+
+    matrix = [[gf_pow2(p, ndata - 1 - x) for x in missing] for p in rows]
+    inv = gf_solve(matrix)
+    result = list(data_cols)
+    for i, x in enumerate(missing):
+        col = np.zeros(size, dtype=np.uint8)
+        for r, syn in enumerate(syndromes):
+            if inv[i][r]:
+                col ^= GF_MUL[inv[i][r]][syn]
+        result[x] = col[:sizes[x]].tobytes()
+    return result
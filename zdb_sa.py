@@ -0,0 +1,131 @@
+import struct
+from array import array
+from collections import namedtuple
+import numpy as np
+from zdb_utils import *
+
+SA_MAGIC = 0x2f505a
+# bonus type of objects whose bonus buffer is a SA header (DMU_OT_SA)
+DMU_OT_SA = 44
+
+SAAttr = namedtuple("SAAttr", "num name length bswap")
+
+# columns of DMUObjset.stat_all(), times are in nanoseconds
+STAT_FIELDS = [
+    ["ZPL_UID", "uid"],
+    ["ZPL_GID", "gid"],
+    ["ZPL_MODE", "mode"],
+    ["ZPL_SIZE", "size"],
+    ["ZPL_LINKS", "links"],
+    ["ZPL_PARENT", "parent"],
+    ["ZPL_GEN", "gen"],
+    ["ZPL_ATIME", "atime"],
+    ["ZPL_MTIME", "mtime"],
+    ["ZPL_CTIME", "ctime"],
+    ["ZPL_CRTIME", "crtime"],
+]
+ZnodeStats = namedtuple("ZnodeStats", ["obj"] + [name for _, name in STAT_FIELDS])
+
+class SASchema:
+    """SA attribute registry and layouts of an objset.
+
+    Loaded once from the SA master node (master node "SA_ATTRS" ->
+    REGISTRY, LAYOUTS) and kept by the objset. Registry lengths of 0 mark
+    variable length attributes, their sizes are stored in the sa_lengths
+    array of each SA header. Attributes are 8 byte aligned after the header.
+    """
+    def __init__(self, objset):
+        sa_obj_id = objset.get_object(1).get_zap("SA_ATTRS")
+        assert sa_obj_id is not None, "SA: no SA_ATTRS in master node"
+        sa_master = objset.get_object(sa_obj_id)
+        registry_id = sa_master.get_zap("REGISTRY")
+        layouts_id = sa_master.get_zap("LAYOUTS")
+        self.attrs = dict()
+        self.names = dict()
+        for name, value, attr_num, attr_bswap, attr_length in objset.get_object(registry_id).iter_sa_attr():
+            self.attrs[attr_num] = SAAttr(attr_num, name, attr_length, attr_bswap)
+            self.names[name] = attr_num
+        self.layouts = dict()
+        for name, layout in objset.get_object(layouts_id).iter_my_zap():
+            if not isinstance(layout, list):
+                layout = [layout]
+            self.layouts[int(name)] = [self.attrs[attr_num] for attr_num in layout]
+        # (layout, var lengths) -> {name: (offset, length, SAAttr)}
+        self.plans = dict()
+        debug_print2(f"SA: {len(self.attrs)} attrs, {len(self.layouts)} layouts", DEBUG_ZFS_OBJECT)
+
+    @staticmethod
+    def parse_hdr(buf):
+        magic, layout_info = struct.unpack_from("IH", buf)
+        assert magic == SA_MAGIC, f"SA: bad magic {magic:#x}"
+        hdrsz = ((layout_info >> 10) & 0x3f) * 8
+        return layout_info & 0x3ff, hdrsz
+
+    def get_plan(self, buf):
+        """{name: (offset, length, SAAttr)} of the attributes in the SA buffer"""
+        layout_num, hdrsz = self.parse_hdr(buf)
+        layout = self.layouts[layout_num]
+        nvar = sum(1 for attr in layout if attr.length == 0)
+        var_lengths = struct.unpack_from(f"{nvar}H", buf, 6) if nvar else ()
+        key = (layout_num, var_lengths)
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = dict()
+            off, var_idx = hdrsz, 0
+            for attr in layout:
+                length = attr.length
+                if length == 0:
+                    length = var_lengths[var_idx]
+                    var_idx += 1
+                plan[attr.name] = (off, length, attr)
+                off += roundup(length, 8)
+            self.plans[key] = plan
+        return plan
+
+    @staticmethod
+    def decode_value(buf, off, length, attr):
+        """Decode by attribute, not by size: variable length attributes
+        (symlink target, ACEs, xattrs) stay bytes whatever their length."""
+        if attr.length == 0:
+            return bytes(buf[off:off + length])
+        if attr.name.endswith("TIME") and length == 16:
+            # timestamps: seconds, nanoseconds
+            return struct.unpack_from("2Q", buf, off)
+        if length == 8:
+            return struct.unpack_from("Q", buf, off)[0]
+        return bytes(buf[off:off + length])
+
+    def decode(self, buf):
+        """All the attributes of a SA buffer as {name: value}"""
+        return {name: self.decode_value(buf, off, length, attr) for name, (off, length, attr) in self.get_plan(buf).items()}
+
+class ZnodeStatsBuilder:
+    """Accumulate STAT_FIELDS of many znodes into typed columns"""
+    def __init__(self, schema):
+        self.schema = schema
+        self.columns = {name: array("q") for name in ZnodeStats._fields}
+        self.names = [(zpl_name, name, zpl_name.endswith("TIME")) for zpl_name, name in STAT_FIELDS]
+        # plan id -> [(column, offset, is_time)], attributes missing from
+        # the layout (e.g. moved to a spill block) read as 0
+        self.extractors = dict()
+
+    def get_extractor(self, plan):
+        ext = self.extractors.get(id(plan))
+        if ext is None:
+            ext = [(self.columns[name], plan.get(zpl_name, (None,))[0], is_time) for zpl_name, name, is_time in self.names]
+            self.extractors[id(plan)] = ext
+        return ext
+
+    def add(self, obj_id, buf):
+        self.columns["obj"].append(obj_id)
+        for column, off, is_time in self.get_extractor(self.schema.get_plan(buf)):
+            if off is None:
+                column.append(0)
+            elif is_time:
+                sec, nsec = struct.unpack_from("2Q", buf, off)
+                column.append(sec * 1000000000 + nsec)
+            else:
+                column.append(struct.unpack_from("q", buf, off)[0])
+
+    def result(self):
+        return ZnodeStats(*[np.frombuffer(self.columns[name], dtype=np.int64) for name in ZnodeStats._fields])
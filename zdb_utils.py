@@ -1,6 +1,9 @@
 from lz4 import block
+import functools
 import math
+import numpy as np
 import os
+import stat
 import struct
 import sys
 from typing import Union, List
@@ -9,6 +12,7 @@ DEBUG_ZFS_BLK       =   ["DBG_BLK", int(os.environ.get("DEBUG_ZFS_BLK", 0))]
 DEBUG_ZFS_VDEV      =   ["DBG_VDEV", int(os.environ.get("DEBUG_ZFS_VDEV", 0))]
 DEBUG_ZFS_ZAP       =   ["DBG_ZAP", int(os.environ.get("DEBUG_ZFS_ZAP", 0))]
 DEBUG_ZFS_OBJECT    =   ["DBG_OBJ", int(os.environ.get("DEBUG_ZFS_OBJECT", 0))]
+DEBUG_ZFS_PREFETCH  =   ["DBG_PREFETCH", int(os.environ.get("DEBUG_ZFS_PREFETCH", 0))]
 DEBUG_SHOW_HEADER    =   int(os.environ.get("DEBUG_ZFS_SHOW_HEADER", 0))
 
 def filter_lvl(lvl):
@@ -50,6 +54,25 @@ def std_write(buf):
         return
     return os.write(1, buf)
 
+def std_is_file():
+    return stat.S_ISREG(os.fstat(1).st_mode)
+
+def std_skip(length):
+    """Skip a hole in the output: seek if stdout is a regular file,
+    otherwise write zeros."""
+    if sys.stdout.isatty():
+        return
+    if std_is_file():
+        return os.lseek(1, length, os.SEEK_CUR)
+    zeros = bytes(min(length, 1 << 20))
+    while length > 0:
+        length -= os.write(1, zeros[:length])
+
+def std_truncate():
+    """Materialize a trailing hole skipped by std_skip."""
+    if not sys.stdout.isatty() and std_is_file():
+        os.ftruncate(1, os.lseek(1, 0, os.SEEK_CUR))
+
 @filter_lvl(4)
 def debug_print4(message, fd=sys.stderr):
     print(message, file=fd)
@@ -64,6 +87,16 @@ def lz4_decompress(block_data, uncompressed_size=0x200000):
     assert len(buf) == uncompressed_size, "lz4 decompress error"
     return buf
 
+def chunked(iterable, n):
+    chunk = []
+    for item in iterable:
+        chunk.append(item)
+        if len(chunk) == n:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
 def bits_get(x, low, length):
     return (x >> low) & ((1 << length) - 1)
 
@@ -95,7 +128,71 @@ class hexdump:
     def __repr__(self):
         return "\n".join(self)
 
-def fletcher4(data: Union[bytes, List[int]]) -> str:
+@functools.lru_cache(maxsize=16)
+def fletcher4_coefs(n):
+    """
+    Fletcher4 的闭式权重：第 i 个字（共 n 个）对 b/c/d 的贡献分别为
+    k、k(k+1)/2、k(k+1)(k+2)/6，其中 k = n - i。
+    用 uint64 的 cumsum 计算，溢出时自然按 2^64 回绕，与逐字累加的结果一致。
+    """
+    k = np.arange(1, n + 1, dtype=np.uint64)
+    cc = np.cumsum(k, dtype=np.uint64)
+    cd = np.cumsum(cc, dtype=np.uint64)
+    coefs = np.stack([k[::-1], cc[::-1], cd[::-1]])
+    coefs.flags.writeable = False
+    return coefs
+
+def as_uint32_words(data):
+    if isinstance(data, np.ndarray):
+        return data.astype(np.uint32, copy=False)
+    if isinstance(data, list):
+        return np.array(data, dtype=np.uint32)
+    # bytes / bytearray / memoryview: 不拷贝，直接按小端 uint32 解释
+    if len(data) % 4 != 0:
+        # 填充字节到4的倍数（ZFS通常按块对齐，此处简化处理）
+        data = bytes(data) + b'\x00' * (4 - len(data) % 4)
+    return np.frombuffer(data, dtype="<u4")
+
+def fletcher4_words(data) -> tuple:
+    """
+    计算 Fletcher4 校验和，返回 (a, b, c, d) 四个 64 位整数
+
+    参数:
+        data: 输入数据（bytes/bytearray/memoryview，或32位无符号整数列表）
+    """
+    words = as_uint32_words(data)
+    if len(words) == 0:
+        return (0, 0, 0, 0)
+    a = words.sum(dtype=np.uint64)
+    b, c, d = fletcher4_coefs(len(words)) @ words.astype(np.uint64)
+    return tuple(int(x) for x in (a, b, c, d))
+
+def fletcher4_batch(blocks) -> list:
+    """
+    一次计算多个数据块的 Fletcher4，返回与 blocks 顺序一致的 (a, b, c, d) 列表。
+    长度相同的块会拼成一个矩阵，一次矩阵乘法算完。
+    """
+    results = [None] * len(blocks)
+    groups = dict()
+    for idx, data in enumerate(blocks):
+        words = as_uint32_words(data)
+        groups.setdefault(len(words), []).append((idx, words))
+    for n, items in groups.items():
+        if n == 0:
+            for idx, _ in items:
+                results[idx] = (0, 0, 0, 0)
+            continue
+        matrix = np.stack([words for _, words in items]).astype(np.uint64)
+        a = matrix.sum(axis=1, dtype=np.uint64)
+        bcd = matrix @ fletcher4_coefs(n).T
+        for row, (idx, _) in enumerate(items):
+            results[idx] = (int(a[row]), int(bcd[row, 0]), int(bcd[row, 1]), int(bcd[row, 2]))
+    return results
+
+def cksum_str(words) -> str:
+    return ":".join([f"{x:x}" for x in words])
+
+def fletcher4(data: Union[bytes, memoryview, List[int]]) -> str:
     """
     计算 Fletcher4 校验和（128位，16字节）
 
@@ -103,32 +200,6 @@ def fletcher4(data: Union[bytes, List[int]]) -> str:
         data: 输入数据（字节串或32位无符号整数列表）
 
     返回:
-        16字节的校验和（字节串，大端序）
+        "a:b:c:d" 形式的十六进制字符串，与 BlkPtr.checksum 格式一致
     """
-
-    data_len = len(data)
-
-    assert data_len <= (8 << 20), f"large lenght not supported: {data_len}"
-    # 初始化累加器
-    a = b = c = d = 0
-
-    # 如果输入是字节流，转换为32位整数列表（小端序）
-    if isinstance(data, bytes):
-        # 填充字节到4的倍数（ZFS通常按块对齐，此处简化处理）
-        if len(data) % 4 != 0:
-            data += b'\x00' * (4 - len(data) % 4)
-        # 解包为uint32列表（小端序）
-        uint32_list = list(struct.unpack(f'<{len(data)//4}I', data))
-    else:
-        uint32_list = data
-
-    # 核心计算：四级累加器
-    for word in uint32_list:
-        a += word
-        b += a
-        c += b
-        d += c
-
-    func = lambda x: (x & 0xFFFFFFFFFFFFFFFF).to_bytes(8, byteorder='big').hex().lstrip("0")
-    return ":".join([func(x) for x in [a, b, c, d]])
-
+    return cksum_str(fletcher4_words(data))
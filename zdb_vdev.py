@@ -1,30 +1,203 @@
 #!/usr/bin/env python3
 
 import argparse
+import errno
 import os
 import json
+import mmap
+import resource
+import stat
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from itertools import combinations
+from zdb_raidz import gen_parity, reconstruct
 from zdb_utils import *
 
+class FDPool:
+    """LRU pool of read-only file descriptors shared by the leaf vdevs.
+
+    Descriptors are opened on first use and kept open; when more paths are
+    open than max_fds, the least recently used idle descriptor is closed.
+    A descriptor is never closed while a reader holds it.
+    """
+    def __init__(self, max_fds=None):
+        if max_fds is None:
+            max_fds = int(os.environ.get("ZDB_MAX_FDS", 0))
+        if max_fds <= 0:
+            soft_limit = resource.getrlimit(resource.RLIMIT_NOFILE)[0]
+            max_fds = max(4, min(1024, soft_limit // 2))
+        self.max_fds = max_fds
+        self.fds = OrderedDict()   # path -> [fd, refs]
+        self.lock = threading.Lock()
+
+    def _evict(self):
+        for path in list(self.fds):
+            if len(self.fds) <= self.max_fds:
+                return
+            fd, refs = self.fds[path]
+            if refs == 0:
+                debug_print2(f"FDPool: evict {path}", DEBUG_ZFS_VDEV)
+                del self.fds[path]
+                os.close(fd)
+
+    def acquire(self, path):
+        with self.lock:
+            ent = self.fds.get(path)
+            if ent is None:
+                debug_print2(f"FDPool: open {path}", DEBUG_ZFS_VDEV)
+                ent = [os.open(path, os.O_RDONLY), 0]
+                self.fds[path] = ent
+            else:
+                self.fds.move_to_end(path)
+            ent[1] += 1
+            self._evict()
+            return ent[0]
+
+    def release(self, path):
+        with self.lock:
+            self.fds[path][1] -= 1
+            self._evict()
+
+    @contextmanager
+    def fd(self, path):
+        fd = self.acquire(path)
+        try:
+            yield fd
+        finally:
+            self.release(path)
+
+    def close(self):
+        with self.lock:
+            for fd, refs in self.fds.values():
+                os.close(fd)
+            self.fds.clear()
+
+    def __del__(self):
+        self.close()
+
 class VDEVLeaf:
-    def __init__(self, **kwargs):
+    label_size = 0x400000
+
+    def __init__(self, fd_pool=None, **kwargs):
         self.id = kwargs['id']
         self.type = kwargs["type"]
         self.path =  kwargs['path']
         assert self.type in ["file", "disk"]
+        self.min_block_size = 1 << kwargs.get("ashift", 9)
+        self.fd_pool = fd_pool if fd_pool is not None else FDPool()
 
     def read(self, offset, size):
         debug_print1(f"VDEVLeaf read at #{self.id} path: {self.path} offset: 0x{offset:x}+0x400000 size={size:x}", DEBUG_ZFS_VDEV)
-        with open(self.path, "rb") as f:
-            f.seek(offset + 0x400000)
-            data = f.read(size)
-            return data
+        with self.fd_pool.fd(self.path) as fd:
+            data = os.pread(fd, size, offset + self.label_size)
+        if len(data) != size:
+            raise OSError(errno.EIO, f"short read at 0x{offset:x}", self.path)
+        return data
+
+    def readinto(self, offset, view):
+        """Read len(view) bytes at offset straight into the memoryview."""
+        debug_print1(f"VDEVLeaf readinto at #{self.id} path: {self.path} offset: 0x{offset:x}+0x400000 size={len(view):x}", DEBUG_ZFS_VDEV)
+        pos = 0
+        with self.fd_pool.fd(self.path) as fd:
+            while pos < len(view):
+                n = os.preadv(fd, [view[pos:]], offset + self.label_size + pos)
+                if n == 0:
+                    raise OSError(errno.EIO, f"short read at 0x{offset + pos:x}", self.path)
+                pos += n
+        return view
+
+    def fault_in(self, data):
+        """Make sure the pages behind data returned by read() are loaded;
+        pread has already done it."""
+        pass
+
+    def leaves(self):
+        return [self]
+
+    def io_plan(self, offset, size):
+        return [(self, offset, size, 0)]
+
+    def close(self):
+        pass
+
+    @staticmethod
+    def create(fd_pool=None, **kwargs):
+        """Leaf vdev with the backend from its config ("backend": "pread",
+        "mmap" or "auto"), ZDB_VDEV_BACKEND otherwise. auto maps regular
+        files (pool images) and preads block devices."""
+        backend = kwargs.get("backend", os.environ.get("ZDB_VDEV_BACKEND", "auto"))
+        assert backend in ["auto", "pread", "mmap"], f"unknown vdev backend: {backend}"
+        if backend == "auto":
+            try:
+                is_file = stat.S_ISREG(os.stat(kwargs["path"]).st_mode)
+            except OSError:
+                is_file = False
+            backend = "mmap" if is_file else "pread"
+        if backend == "mmap":
+            return VDEVLeafMmap(fd_pool, **kwargs)
+        return VDEVLeaf(fd_pool, **kwargs)
 
     def __repr__(self):
         return f"<Vdev:{self.id}:{self.path}>"
 
+class VDEVLeafMmap(VDEVLeaf):
+    """Leaf backed by a read-only mapping of the whole device. Reads return
+    memoryviews into the mapping, so nothing is copied and the page cache
+    is shared with every other process mapping the same image."""
+    def __init__(self, fd_pool=None, **kwargs):
+        super().__init__(fd_pool, **kwargs)
+        self.mm = None
+        self.lock = threading.Lock()
+
+    def get_map(self):
+        with self.lock:
+            if self.mm is None:
+                debug_print2(f"VDEVLeafMmap: map {self.path}", DEBUG_ZFS_VDEV)
+                fd = os.open(self.path, os.O_RDONLY)
+                try:
+                    self.mm = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+                finally:
+                    os.close(fd)
+                self.view = memoryview(self.mm)
+            return self.view
+
+    def read(self, offset, size):
+        debug_print1(f"VDEVLeafMmap read at #{self.id} path: {self.path} offset: 0x{offset:x}+0x400000 size={size:x}", DEBUG_ZFS_VDEV)
+        start = offset + self.label_size
+        data = self.get_map()[start:start + size]
+        if len(data) != size:
+            raise OSError(errno.EIO, f"short read at 0x{offset:x}", self.path)
+        return data
+
+    def readinto(self, offset, view):
+        view[:] = self.read(offset, len(view))
+        return view
+
+    def fault_in(self, data):
+        # touch one byte per page (and the last one), the view stays a view
+        if len(data):
+            data[::mmap.PAGESIZE].tobytes()
+            data[-1]
+
+    def close(self):
+        with self.lock:
+            if self.mm is None:
+                return
+            self.view.release()
+            try:
+                self.mm.close()
+            except BufferError:
+                # blocks handed out (e.g. in the block cache) still use it
+                pass
+            self.mm = None
+
 class VDEVRaidZ:
-    def __init__(self, **kwargs):
+    def __init__(self, fd_pool=None, executor=None, **kwargs):
         self.id = kwargs["id"]
+        self.executor = executor
         self.guid = kwargs['guid']
         self.ashift = kwargs["ashift"]
         self.nparity = kwargs["nparity"]
@@ -32,12 +205,15 @@ class VDEVRaidZ:
         self.children = dict()
         self.dcols = len(self.child_config)
         for child in self.child_config:
-            self.add_child(VDEVLeaf(**child))
+            self.add_child(VDEVLeaf.create(fd_pool, **child))
         self.min_block_size = 1 << self.ashift
 
     def add_child(self, child):
         self.children[child.id] = child
 
+    def leaves(self):
+        return list(self.children.values())
+
     def __repr__(self):
         return f"<Raidz{self.nparity}:{self.children}>"
 
@@ -97,28 +273,198 @@ class VDEVRaidZ:
             asize += rc['rc_size']
             rr_col.append(rc)
 
+        # raidz1 switches parity and the first data column every 1MB,
+        # so parity does not always sit on the same disk
+        if nparity == 1 and io_offset & (1 << 20):
+            rr_col[0]['rc_devidx'], rr_col[1]['rc_devidx'] = rr_col[1]['rc_devidx'], rr_col[0]['rc_devidx']
+            rr_col[0]['rc_offset'], rr_col[1]['rc_offset'] = rr_col[1]['rc_offset'], rr_col[0]['rc_offset']
+
         rr['rr_col'] = rr_col
         return rr
 
-    def read_chunks(self, rr):
+    def io_plan(self, io_offset, io_size):
+        rr = self.vdev_raiz_map_alloc(io_offset, io_size, self.ashift, self.dcols, self.nparity)
+        return self.data_plan(rr)
+
+    def data_plan(self, rr):
+        """(child, child_offset, size, dst_offset) of the data columns"""
+        plan = []
+        dst_offset = 0
         for rc in rr['rr_col'][rr['rr_firstdatacol']:]:
             rc_size = rc['rc_size']
             if rc_size > 0:
-                devidx = rc['rc_devidx']
-                dev = self.children[devidx]
-                yield dev.read(rc['rc_offset'], rc_size)
+                plan.append((self.children[rc['rc_devidx']], rc['rc_offset'], rc_size, dst_offset))
+                dst_offset += rc_size
+        return plan
 
     def read(self, io_offset, io_size):
         debug_print1(f"Raidz{self.nparity} read vdev: {self.id}, disk: {self.dcols}, ashift: {self.ashift} ({1<<self.ashift})", DEBUG_ZFS_VDEV)
         rr = self.vdev_raiz_map_alloc(io_offset, io_size, self.ashift, self.dcols, self.nparity)
         debug_print2(json.dumps(rr, indent=4), DEBUG_ZFS_VDEV)
-        data = b''
-        for chunk in self.read_chunks(rr):
-            data += chunk
+        plan = self.data_plan(rr)
+        data = bytearray(sum(size for _, _, size, _ in plan))
+        view = memoryview(data)
+        read_col = lambda p: p[0].readinto(p[1], view[p[3]:p[3]+p[2]])
+        try:
+            # columns live on different disks, read them in parallel
+            if self.executor is not None and len(plan) > 1:
+                list(self.executor.map(read_col, plan))
+            else:
+                for p in plan:
+                    read_col(p)
+        except OSError as e:
+            debug_print1(f"Raidz{self.nparity}: degraded read at 0x{io_offset:x}: {e}", DEBUG_ZFS_VDEV)
+            cols = self.read_cols(rr)
+            missing = [j for j, col in enumerate(cols[self.nparity:]) if col is None]
+            return self.reconstruct(rr, cols, missing)
         return data
 
+    def read_cols(self, rr):
+        """Read every column, parity included; unreadable ones are None."""
+        cols = []
+        for rc in rr['rr_col'][:rr['rr_cols']]:
+            buf = bytearray(rc['rc_size'])
+            try:
+                self.children[rc['rc_devidx']].readinto(rc['rc_offset'], memoryview(buf))
+            except OSError as e:
+                debug_print1(f"Raidz{self.nparity}: column on #{rc['rc_devidx']} unreadable: {e}", DEBUG_ZFS_VDEV)
+                buf = None
+            cols.append(buf)
+        return cols
+
+    def reconstruct(self, rr, cols, missing):
+        """Rebuild the data columns listed in missing (indexes among the
+        data columns) from parity and return the whole block."""
+        debug_print1(f"Raidz{self.nparity}: rebuild data columns {missing}", DEBUG_ZFS_VDEV)
+        parity, data = cols[:self.nparity], cols[self.nparity:]
+        sizes = [rc['rc_size'] for rc in rr['rr_col'][self.nparity:rr['rr_cols']]]
+        return bytearray(b"".join(reconstruct(parity, data, missing, sizes)))
+
+    def verify_parity(self, io_offset, io_size):
+        """Compare each parity column with parity generated from the data
+        columns: True/False per column, None if it can't be checked."""
+        rr = self.vdev_raiz_map_alloc(io_offset, io_size, self.ashift, self.dcols, self.nparity)
+        cols = self.read_cols(rr)
+        parity, data = cols[:self.nparity], cols[self.nparity:]
+        if None in data:
+            return [None] * self.nparity
+        expect = gen_parity(data, self.nparity, rr['rr_col'][0]['rc_size'])
+        return [None if p is None else p == e.tobytes() for p, e in zip(parity, expect)]
+
+    def iter_alternates(self, io_offset, io_size):
+        """Other possible contents of a block that failed its checksum:
+        rebuilt from parity assuming 1..nparity data columns are bad,
+        like the combinatorial reconstruction in vdev_raidz."""
+        rr = self.vdev_raiz_map_alloc(io_offset, io_size, self.ashift, self.dcols, self.nparity)
+        cols = self.read_cols(rr)
+        ndata = len(cols) - self.nparity
+        bad = [j for j in range(ndata) if cols[self.nparity + j] is None]
+        good = [j for j in range(ndata) if cols[self.nparity + j] is not None]
+        navail = sum(p is not None for p in cols[:self.nparity])
+        for n in range(max(1, len(bad)), navail + 1):
+            for extra in combinations(good, n - len(bad)):
+                yield self.reconstruct(rr, cols, sorted(bad + list(extra)))
+
+class VDEVMirror:
+    def __init__(self, fd_pool=None, **kwargs):
+        self.id = kwargs["id"]
+        self.guid = kwargs['guid']
+        self.ashift = kwargs["ashift"]
+        self.min_block_size = 1 << self.ashift
+        self.children = [VDEVLeaf.create(fd_pool, **child) for child in kwargs["children"]]
+        # per child: reads in flight and moving average of read latency
+        self.pending = [0] * len(self.children)
+        self.latency = [0.0] * len(self.children)
+        self.lock = threading.Lock()
+
+    def __repr__(self):
+        return f"<Mirror:{self.children}>"
+
+    def leaves(self):
+        return self.children
+
+    def io_plan(self, offset, size, idx):
+        # the whole batch goes to the one child read_many got from select(),
+        # so adjacent blocks can merge
+        return [(self.children[idx], offset, size, 0)]
+
+    def select(self, exclude=()):
+        """Pick the child with the fewest reads in flight, then the lowest
+        observed latency, as vdev_mirror_child_select does with its load.
+        The latency of the children passed over decays, so one slow sample
+        does not keep a child idle for good."""
+        with self.lock:
+            candidates = [i for i in range(len(self.children)) if i not in exclude]
+            if not candidates:
+                return None
+            idx = min(candidates, key=lambda i: (self.pending[i], self.latency[i]))
+            self.pending[idx] += 1
+            for i in candidates:
+                if i != idx:
+                    self.latency[i] *= 0.875
+            return idx
+
+    def io_done(self, idx, elapsed=None):
+        """Account a read from select() as finished, elapsed is None if it
+        failed"""
+        with self.lock:
+            self.pending[idx] -= 1
+            if elapsed is not None:
+                self.latency[idx] = self.latency[idx] * 0.875 + elapsed * 0.125
+
+    def read_child(self, idx, offset, size):
+        start = time.perf_counter()
+        elapsed = None
+        try:
+            child = self.children[idx]
+            data = child.read(offset, size)
+            # mmap reads fault later, in checksum and decompress; do it now
+            # so the time counts for this child
+            child.fault_in(data)
+            elapsed = time.perf_counter() - start
+            return data
+        finally:
+            self.io_done(idx, elapsed)
+
+    def read(self, offset, size):
+        debug_print1(f"Mirror read vdev: {self.id}, children: {len(self.children)}", DEBUG_ZFS_VDEV)
+        tried = []
+        while True:
+            idx = self.select(tried)
+            if idx is None:
+                raise OSError(f"mirror {self.id}: no readable child at 0x{offset:x}")
+            tried.append(idx)
+            try:
+                return self.read_child(idx, offset, size)
+            except OSError as e:
+                debug_print1(f"Mirror: child {self.children[idx]} failed: {e}", DEBUG_ZFS_VDEV)
+
+    def iter_alternates(self, offset, size):
+        """The block as read from each child, for retry after a checksum
+        error."""
+        for idx, child in enumerate(self.children):
+            with self.lock:
+                self.pending[idx] += 1
+            try:
+                yield self.read_child(idx, offset, size)
+            except OSError as e:
+                debug_print1(f"Mirror: child {child} failed: {e}", DEBUG_ZFS_VDEV)
+
 class VDEVHandler:
-    def __init__(self, nv_config_list):
+    # config path -> (mtime_ns, handler), shared by the whole process
+    registry = dict()
+    registry_lock = threading.Lock()
+
+    def __init__(self, nv_config_list, max_fds=None, threads=None):
+        self.fd_pool = FDPool(max_fds)
+        # like zfs_vdev_read_gap_limit / zfs_vdev_aggregation_limit
+        self.coalesce_gap = int(os.environ.get("ZDB_COALESCE_GAP", 32 << 10))
+        self.coalesce_max = int(os.environ.get("ZDB_COALESCE_MAX", 1 << 20))
+        if threads is None:
+            threads = int(os.environ.get("ZDB_VDEV_THREADS", 0))
+        self.executor = None
+        if threads > 0:
+            self.executor = ThreadPoolExecutor(threads, thread_name_prefix="zdb_vdev")
         self.vdev_dict = dict()
         self.vdev_guid_dict = dict()
         for nv_config in nv_config_list:
@@ -128,21 +474,142 @@ class VDEVHandler:
             if vdev_id in self.vdev_dict:
                 assert self.vdev_guid_dict[vdev_id] == vdev_guid
                 continue
-            assert vdev_conf['type'] in ['raidz', 'file', 'disk'], "Only raidz and file vdev are supported"
+            assert vdev_conf['type'] in ['raidz', 'mirror', 'file', 'disk'], "Only raidz, mirror and file vdev are supported"
             if vdev_conf['type'] == 'raidz':
-                vdev = VDEVRaidZ(**vdev_conf)
+                vdev = VDEVRaidZ(self.fd_pool, self.executor, **vdev_conf)
+            elif vdev_conf['type'] == 'mirror':
+                vdev = VDEVMirror(self.fd_pool, **vdev_conf)
             elif vdev_conf['type'] in ['file', 'disk']:
-                vdev = VDEVLeaf(**vdev_conf)
+                vdev = VDEVLeaf.create(self.fd_pool, **vdev_conf)
             self.vdev_dict[vdev_id] = vdev
             self.vdev_guid_dict[vdev_id] = vdev_guid
 
     def read_vdev(self, vdev_id, io_offset, io_size):
         vdev = self.vdev_dict[vdev_id]
         vdev_size = roundup(io_size, vdev.min_block_size)
-        data = vdev.read(io_offset, vdev_size)[:io_size]
+        data = vdev.read(io_offset, vdev_size)
+        if len(data) != io_size:
+            data = memoryview(data)[:io_size]
         assert io_size == len(data)
         return data
 
+    @classmethod
+    def from_config(cls, vdev_conf="nvlist.json"):
+        """Return the process-wide handler for vdev_conf, parsing it only
+        when it is seen for the first time or its mtime has changed. The
+        handler of a changed config is only dropped from the registry:
+        objsets and prefetch threads may still read through it, its fds,
+        maps and threads go when the last of them lets go of it."""
+        path = os.path.abspath(vdev_conf)
+        mtime = os.stat(path).st_mtime_ns
+        with cls.registry_lock:
+            ent = cls.registry.get(path)
+            if ent is not None and ent[0] == mtime:
+                return ent[1]
+            debug_print1(f"VDEVHandler: loading config {path}", DEBUG_ZFS_VDEV)
+            with open(path) as f:
+                handler = cls(json.load(f))
+            cls.registry[path] = (mtime, handler)
+            return handler
+
+    def read_many(self, reqs):
+        """Read a batch of (vdev_id, offset, size) requests, results in
+        request order.
+
+        Requests are split into per leaf segments and each leaf's segments
+        are sorted by offset (elevator order). Segments that are adjacent
+        or less than coalesce_gap apart are merged into one read of at most
+        coalesce_max bytes, then scattered back into the request buffers.
+        """
+        results = []
+        segs = dict()  # leaf -> [(leaf_offset, size, dst view)]
+        picked = dict()  # mirror -> [child idx from select(), requests]
+        for vdev_id, io_offset, io_size in reqs:
+            vdev = self.vdev_dict[vdev_id]
+            vdev_size = roundup(io_size, vdev.min_block_size)
+            view = memoryview(bytearray(vdev_size))
+            if hasattr(vdev, "select"):
+                if vdev not in picked:
+                    picked[vdev] = [vdev.select(), 0]
+                picked[vdev][1] += 1
+                plan = vdev.io_plan(io_offset, vdev_size, picked[vdev][0])
+            else:
+                plan = vdev.io_plan(io_offset, vdev_size)
+            for leaf, leaf_offset, size, dst_offset in plan:
+                segs.setdefault(leaf, []).append((leaf_offset, size, view[dst_offset:dst_offset+size]))
+            results.append(view[:io_size])
+        elapsed = dict()  # leaf -> time spent reading its runs
+        try:
+            try:
+                for leaf, items in segs.items():
+                    start = time.perf_counter()
+                    items.sort(key=lambda x: x[0])
+                    for run in self.coalesce(items):
+                        self.read_run(leaf, run)
+                    elapsed[leaf] = time.perf_counter() - start
+            finally:
+                # the batch counts as one read per mirror, its latency
+                # sample is the time per request
+                for vdev, (idx, nreqs) in picked.items():
+                    spent = elapsed.get(vdev.children[idx])
+                    vdev.io_done(idx, None if spent is None else spent / nreqs)
+        except OSError as e:
+            # a leaf is gone, let every vdev handle its own redundancy
+            debug_print1(f"read_many: {e}, falling back to single reads", DEBUG_ZFS_VDEV)
+            return [self.read_vdev(*req) for req in reqs]
+        return results
+
+    def coalesce(self, items):
+        run = [items[0]]
+        run_start, run_end = items[0][0], items[0][0] + items[0][1]
+        for item in items[1:]:
+            offset, size, _ = item
+            end = max(run_end, offset + size)
+            if offset <= run_end + self.coalesce_gap and end - run_start <= self.coalesce_max:
+                run.append(item)
+                run_end = end
+                continue
+            yield run
+            run = [item]
+            run_start, run_end = offset, offset + size
+        yield run
+
+    def read_run(self, leaf, run):
+        if len(run) == 1:
+            offset, size, view = run[0]
+            leaf.readinto(offset, view)
+            return
+        start = run[0][0]
+        end = max(offset + size for offset, size, _ in run)
+        debug_print2(f"read_many: {leaf} merged {len(run)} reads 0x{start:x}+0x{end - start:x}", DEBUG_ZFS_VDEV)
+        data = memoryview(leaf.read(start, end - start))
+        for offset, size, view in run:
+            view[:] = data[offset - start:offset - start + size]
+
+    def iter_alternates(self, vdev_id, io_offset, io_size):
+        """Other copies or reconstructions of a block, for vdevs that have
+        redundancy (used when the first read fails its checksum)."""
+        vdev = self.vdev_dict[vdev_id]
+        if not hasattr(vdev, "iter_alternates"):
+            return
+        vdev_size = roundup(io_size, vdev.min_block_size)
+        for data in vdev.iter_alternates(io_offset, vdev_size):
+            yield memoryview(data)[:io_size]
+
+    def close(self):
+        for vdev in self.vdev_dict.values():
+            for leaf in vdev.leaves():
+                leaf.close()
+        self.fd_pool.close()
+        if self.executor is not None:
+            self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
 def parse_arg():
     parser = argparse.ArgumentParser()
     parser.add_argument("--config", metavar="nvlist.json", default="nvlist.json")
@@ -152,14 +619,13 @@ def parse_arg():
 
 
 def vdev_read(vdev_id, offset, io_size, vdev_conf="nvlist.json"):
-    with open(vdev_conf) as f:
-        return VDEVHandler(json.load(f)).read_vdev(vdev_id, offset, io_size)
+    return VDEVHandler.from_config(vdev_conf).read_vdev(vdev_id, offset, io_size)
 
 def main():
     args = parse_arg()
     if args.ptr:
         from zdb_blkptr import BlkPtr
-        return BlkPtr.read_ptr(args.ptr)
+        return BlkPtr.read_ptr(args.ptr, handler=VDEVHandler.from_config(args.config))
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
@@ -1,8 +1,54 @@
 import struct
 import os
+import unicodedata
 from collections import namedtuple
+import numpy as np
+from zdb_prefetch import Prefetcher
 from zdb_utils import *
 
+# zap_hash(): salted CRC64 (ECMA-182 reflected) of the normalized name,
+# only the top zap_hashbits() bits are kept
+ZFS_CRC64_POLY = 0xC96C5795D7870F42
+ZAP_FLAG_HASH64 = 1 << 0
+ZAP_FLAG_PRE_HASHED_KEY = 1 << 1
+ZAP_FLAG_UINT64_KEY = 1 << 2
+
+def _crc64_table():
+    table = []
+    for i in range(256):
+        crc = i
+        for _ in range(8):
+            crc = (crc >> 1) ^ (ZFS_CRC64_POLY if crc & 1 else 0)
+        table.append(crc)
+    return table
+
+zfs_crc64_table = _crc64_table()
+
+# u8_textprep flags used in zap_normflags, see u8_textprep.h
+U8_TEXTPREP_TOUPPER = 0x02
+U8_TEXTPREP_TOLOWER = 0x04
+U8_NORMALIZATION_FORMS_MASK = 0x70
+U8_TEXTPREP_FORMS = {0x10: "NFD", 0x20: "NFKD", 0x50: "NFC", 0x60: "NFKC"}
+
+def zap_normalize(name, normflags):
+    # u8_textprep_str converts the case, then normalizes to one form
+    if normflags & U8_TEXTPREP_TOUPPER:
+        name = name.upper()
+    elif normflags & U8_TEXTPREP_TOLOWER:
+        name = name.lower()
+    form = U8_TEXTPREP_FORMS.get(normflags & U8_NORMALIZATION_FORMS_MASK)
+    if form is not None:
+        name = unicodedata.normalize(form, name)
+    return name
+
+def zap_hash(name, salt, flags=0, normflags=0):
+    assert salt != 0, "zap: salt is 0"
+    bits = 48 if flags & ZAP_FLAG_HASH64 else 28
+    h = salt
+    for c in zap_normalize(name, normflags).encode():
+        h = (h >> 8) ^ zfs_crc64_table[(h ^ c) & 0xff]
+    return h & ~((1 << (64 - bits)) - 1)
+
 class ZapRegistry:
     type_to_class = dict()
 
@@ -25,6 +71,11 @@ class ZapCommon:
     def iter_ent(self, obj):
         return []
 
+    def lookup(self, obj, qname):
+        for name, value in self.iter_ent(obj):
+            if name == qname:
+                return value
+
 class MicroZap(ZapCommon):
     my_type = (1<< 63) + 3
     mzap_ent_len = 64
@@ -45,6 +96,15 @@ class MicroZap(ZapCommon):
             offset += self.mzap_ent_len
         return
 
+    def lookup(self, obj, qname):
+        # mzap_phys_t: mz_block_type, mz_salt, mz_normflags
+        normflags = struct.unpack_from("Q", self.buf, 16)[0]
+        if normflags:
+            qname = zap_normalize(qname, normflags)
+        for name, value in self.iter_ent(obj):
+            if name == qname or (normflags and zap_normalize(name, normflags) == qname):
+                return value
+
 Zle = namedtuple("ZapLeafEntry", "le_type le_value_intlen le_next le_name_chunk le_name_minints le_value_chunk le_value_numints le_cd le_hash")
 Zla = namedtuple("ZapLeafArray", "la_type la_array la_next")
 LHdr = namedtuple("LHdr", "lh_block_type lh_pad1 lh_prefix lh_magic lh_nfree lh_nentries lh_prefix_len lh_freelist lh_flags")
@@ -56,16 +116,9 @@ class LeafZap(ZapCommon):
     def __init__(self, buf):
         super().__init__(buf)
         self.hdr = LHdr(*struct.unpack_from("3QIHHHHB", buf))
-        max_entries = len(buf) // 32
-        entries = []
-        for i in range(max_entries):
-            off = self.hdr_len + 2*i
-            idx = struct.unpack_from("H", buf, off)[0]
-            if idx == 0xffff:
-                continue
-            entries.append(idx)
-        self.entries = entries
-        self.ent_start = max_entries * 2 + self.hdr_len
+        # hash table of len(buf) / 32 chain heads, then the chunks
+        self.ent_start = len(buf) // 32 * 2 + self.hdr_len
+        self.nchunks = (len(buf) - self.ent_start) // self.bs
 
     def get_off(self, idx):
         return idx * self.bs + self.ent_start
@@ -75,7 +128,7 @@ class LeafZap(ZapCommon):
 
     def get_zle(self, idx):
         zle = Zle(*self.unpack("2B5HIQ", idx))
-        assert zle.le_type == 252 and zle.le_next == 0xffff
+        assert zle.le_type == 252, f"zap leaf: chunk {idx} is not an entry"
         return zle
 
     def get_zla(self, idx):
@@ -85,19 +138,47 @@ class LeafZap(ZapCommon):
             return zla.la_array
         return zla.la_array + self.get_zla(zla.la_next)
 
-    def iter_ent(self, obj):
-        pack_size = {1: "B", 2: "H", 4: "I", 8: "Q"}
-        for idx in self.entries:
+    def iter_chain(self, idx):
+        """entries of one hash chain, linked by le_next"""
+        while idx != 0xffff:
             zle = self.get_zle(idx)
-            raw_name, raw_value = self.get_zla(zle.le_name_chunk), self.get_zla(zle.le_value_chunk)
-            name = raw_name[:zle.le_name_minints].decode()
-            pack_fmt = f">{zle.le_value_numints}{pack_size[zle.le_value_intlen]}"
-            value_list = struct.unpack_from(pack_fmt, raw_value)
-            if zle.le_value_numints == 1:
-                value = value_list[0]
-            else:
-                value = list(value_list)
-            yield name, value
+            yield zle
+            idx = zle.le_next
+
+    def get_name(self, zle):
+        return self.get_zla(zle.le_name_chunk)[:zle.le_name_minints].decode()
+
+    def get_value(self, zle):
+        pack_size = {1: "B", 2: "H", 4: "I", 8: "Q"}
+        raw_value = self.get_zla(zle.le_value_chunk)
+        pack_fmt = f">{zle.le_value_numints}{pack_size[zle.le_value_intlen]}"
+        value_list = struct.unpack_from(pack_fmt, raw_value)
+        if zle.le_value_numints == 1:
+            return value_list[0]
+        return list(value_list)
+
+    def iter_ent(self, obj):
+        # every entry chunk is on exactly one hash chain, so scanning the
+        # chunks for entries finds them all without walking the chains
+        chunk_types = np.frombuffer(self.buf, dtype=np.uint8, count=self.nchunks * self.bs,
+                                    offset=self.ent_start).reshape(-1, self.bs)[:, 0]
+        for idx in np.flatnonzero(chunk_types == 252):
+            zle = self.get_zle(int(idx))
+            yield self.get_name(zle), self.get_value(zle)
+
+    def lookup_hash(self, h, qname, normflags=0):
+        """LEAF_HASH: the hash bits right below the leaf prefix pick the
+        chain, entries on it are matched by hash then by (normalized) name"""
+        nhash = len(self.buf) // 32
+        shift = nhash.bit_length() - 1
+        head_idx = (h >> (64 - shift - self.hdr.lh_prefix_len)) & (nhash - 1)
+        head = struct.unpack_from("H", self.buf, self.hdr_len + 2 * head_idx)[0]
+        for zle in self.iter_chain(head):
+            if zle.le_hash != h:
+                continue
+            name = self.get_name(zle)
+            if name == qname or (normflags and zap_normalize(name, normflags) == zap_normalize(qname, normflags)):
+                return self.get_value(zle)
 
 
 class FatZap(ZapCommon):
@@ -109,21 +190,57 @@ class FatZap(ZapCommon):
     def __init__(self, buf):
         super().__init__(buf)
         self.hdr = self.ZapHdr(*struct.unpack_from("13Q", buf))
-        assert self.hdr.zt_numblks == 0, "Only embed ptr table is supported"
+        assert self.hdr.zap_magic == self.magic, f"FatZap: bad magic {self.hdr.zap_magic:#x}"
+
+    def get_ptr(self, obj, idx):
+        """leaf blkid of pointer table entry idx"""
+        if self.hdr.zt_numblks == 0:
+            # embedded in the second half of the header block
+            return struct.unpack_from("Q", self.buf, len(self.buf) // 2 + 8 * idx)[0]
+        per_blk = len(self.buf) // 8
+        buf = obj.read_blk(self.hdr.zt_blk + idx // per_blk).buf
+        return struct.unpack_from("Q", buf, 8 * (idx % per_blk))[0]
+
+    def iter_ptrtbl(self, obj):
+        """the pointer table as uint64 arrays, one per block"""
+        if self.hdr.zt_numblks == 0:
+            half_len = len(self.buf) // 2
+            yield np.frombuffer(self.buf, dtype=np.uint64, count=half_len // 8, offset=half_len)
+            return
+        for blkid in range(self.hdr.zt_blk, self.hdr.zt_blk + self.hdr.zt_numblks):
+            yield np.frombuffer(obj.read_blk(blkid).buf, dtype=np.uint64)
+
+    def iter_leaf_blkids(self, obj):
+        """every leaf blkid once, in pointer table order"""
+        seen = set()
+        for ptrs in self.iter_ptrtbl(obj):
+            # a leaf covers a run of consecutive entries
+            runs = ptrs[np.r_[True, ptrs[1:] != ptrs[:-1]]]
+            for blkid in runs.tolist():
+                if blkid not in seen:
+                    seen.add(blkid)
+                    yield blkid
+
+    def lookup(self, obj, qname):
+        if self.hdr.zap_flags & (ZAP_FLAG_PRE_HASHED_KEY | ZAP_FLAG_UINT64_KEY):
+            return super().lookup(obj, qname)
+        h = zap_hash(qname, self.hdr.zap_salt, self.hdr.zap_flags, self.hdr.zap_normflags)
+        # ZAP_HASH_IDX: the top zt_shift bits index the pointer table
+        idx = h >> (64 - self.hdr.zt_shift) if self.hdr.zt_shift else 0
+        blkid = self.get_ptr(obj, idx)
+        debug_print2(f"FatZap: lookup {qname} hash {h:016x} ptrtbl[{idx}] -> leaf {blkid}", DEBUG_ZFS_ZAP)
+        leaf = LeafZap(obj.read_blk(blkid).buf)
+        return leaf.lookup_hash(h, qname + "\0", self.hdr.zap_normflags)
 
     def iter_ent(self, obj):
+        """Stream the entries leaf by leaf; leaves are read ahead with the
+        default Prefetcher, so memory stays bounded by its window."""
         debug_print1("iterating fatzap:", DEBUG_ZFS_ZAP)
         debug_print2(f"FatZap header: {self.hdr}", DEBUG_ZFS_ZAP)
-        buf_len = len(self.buf)
-        half_len = buf_len // 2
-        blkid_list = []
-        for i in range(0, half_len, 8):
-            off = half_len + i
-            blkid = struct.unpack_from("Q", self.buf, off)[0]
-            if blkid not in blkid_list:
-                blkid_list.append(blkid)
-                blkdata = obj.read_blk(blkid)
-                leaf = LeafZap(blkdata.buf)
-                for name, value in leaf.iter_ent(obj):
-                    yield name[:-1], value
-        
\ No newline at end of file
+        prefetch = Prefetcher.get_default()
+        read = lambda blkid: obj.read_blk(blkid).buf
+        blkids = self.iter_leaf_blkids(obj)
+        leaves = map(read, blkids) if prefetch is None else prefetch.map(read, blkids)
+        for buf in leaves:
+            for name, value in LeafZap(buf).iter_ent(obj):
+                yield name[:-1], value